@@ -1,10 +1,63 @@
+import os
+
 import numpy as np
 
 cimport numpy as cnp
 cimport cython
+from cython.parallel cimport prange
+from libc.math cimport fabsf
 
-DTYPE = np.float
+DTYPE = np.float64
 ctypedef cnp.float_t DTYPE_t
+ctypedef cnp.float32_t F32_t
+ctypedef cnp.float64_t F64_t
+ctypedef cnp.intp_t INDEX_t
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef Py_ssize_t _backtrack(F64_t[:, ::1] cost, INDEX_t[::1] path_a,
+                           INDEX_t[::1] path_b) noexcept nogil:
+    """Backtrack through an accumulated cost matrix
+
+    Fill "path_a" and "path_b" arrays backwards from the end with
+    indices of the backtracked path; return the index where the path
+    starts.
+    """
+    cdef Py_ssize_t i = cost.shape[0] - 1
+    cdef Py_ssize_t j = cost.shape[1] - 1
+    cdef Py_ssize_t k = path_a.shape[0] - 1
+    cdef F64_t s, t, u
+    while i and j:
+        path_a[k] = i
+        path_b[k] = j
+        k -= 1
+        s = cost[i-1, j-1]
+        t = cost[i, j-1]
+        u = cost[i-1, j]
+        # which is smallest?  (want to prefer s in case of tie)
+        if s <= t:  # it's not t
+            if s <= u:  # s is smallest
+                i -= 1
+                j -= 1
+            else:  # u is smallest
+                i -= 1
+        else:  # it's not s
+            if t <= u:  # t is smallest
+                j -= 1
+            else:  # s is smallest
+                i -= 1
+    while i:
+        path_a[k] = i
+        path_b[k] = j
+        k -= 1
+        i -= 1
+    while j:
+        path_a[k] = i
+        path_b[k] = j
+        k -= 1
+        j -= 1
+    return k
 
 
 @cython.boundscheck(False)
@@ -19,10 +72,10 @@ def dtw(input1, input2):
     assert v_len == b.shape[1]
     cdef DTYPE_t[:, ::1] cost = np.zeros([a_len, b_len], dtype=DTYPE, order='C')
     cdef unsigned int i, j, k
-    cdef DTYPE_t s, t, u
+    cdef DTYPE_t s, t
     cdef unsigned int bt_len = a_len + b_len
-    cdef cnp.uint_t[::1] path_a = np.zeros([bt_len], dtype=np.uint, order='C')
-    cdef cnp.uint_t[::1] path_b = np.zeros([bt_len], dtype=np.uint, order='C')
+    cdef INDEX_t[::1] path_a = np.zeros([bt_len], dtype=np.intp, order='C')
+    cdef INDEX_t[::1] path_b = np.zeros([bt_len], dtype=np.intp, order='C')
 
     with nogil:
         # Cython currently does not check if Python objects are manipulated
@@ -66,41 +119,309 @@ def dtw(input1, input2):
 
                 cost[i, j] += s
 
-        # Backtrack
-        # Fill "path_a" and "path_b" arrays backwards from the end with
-        # indices of the backtracked path; then return only the parts filled
+        k = _backtrack(cost, path_a, path_b)
+
+    dist = cost[a_len-1, b_len-1] / (a_len + b_len)
+
+    return dist, cost, np.array([path_a[k:], path_b[k:]], dtype=np.uint)
+
+
+# Backtracking steps
+cdef enum:
+    STEP_DIAG = 0
+    STEP_LEFT = 1  # to (i, j-1)
+    STEP_UP = 2  # to (i-1, j)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def dtw_corridor(input1, input2, lo_limits, hi_limits):
+    """Like dtw, but only consider cells within a corridor
+
+    Row i covers columns lo_limits[i] <= j < hi_limits[i]. The corridor
+    must be connected (see talk_video_maker.dtw.connect_corridor).
+    Paths are the same as dtw's if the optimal path stays in the corridor.
+    Only two rows of accumulated costs are kept, plus one byte per corridor
+    cell for backtracking.
+
+    Returns (dist, path).
+    """
+    cdef F64_t[:, ::1] a = np.array(input1, dtype=np.float64, order='C')
+    cdef F64_t[:, ::1] b = np.array(input2, dtype=np.float64, order='C')
+
+    cdef Py_ssize_t a_len = a.shape[0]
+    cdef Py_ssize_t b_len = b.shape[0]
+    cdef Py_ssize_t v_len = a.shape[1]
+    assert v_len == b.shape[1]
+
+    lo_array = np.array(lo_limits, dtype=np.intp)
+    hi_array = np.array(hi_limits, dtype=np.intp)
+    assert len(lo_array) == len(hi_array) == a_len
+    assert lo_array[0] == 0 and hi_array[-1] == b_len
+    assert np.all(lo_array < hi_array) and np.all(lo_array >= 0)
+    assert np.all(np.diff(lo_array) >= 0) and np.all(np.diff(hi_array) >= 0)
+    assert np.all(lo_array[1:] <= hi_array[:-1])
+    cdef INDEX_t[::1] lo = lo_array
+    cdef INDEX_t[::1] hi = hi_array
+    offsets_array = np.zeros(a_len + 1, dtype=np.intp)
+    np.cumsum(hi_array - lo_array, out=offsets_array[1:])
+    cdef INDEX_t[::1] offsets = offsets_array
+    cdef cnp.uint8_t[::1] steps = np.empty(offsets_array[-1], dtype=np.uint8)
+    cdef F64_t[:, ::1] rows = np.empty([2, b_len], dtype=np.float64)
+
+    cdef Py_ssize_t i, j, k
+    cdef Py_ssize_t row, prev_row, prev_lo, prev_hi
+    cdef F64_t s, d, best
+    cdef cnp.uint8_t step
+    cdef Py_ssize_t bt_len = a_len + b_len
+    cdef INDEX_t[::1] path_a = np.zeros([bt_len], dtype=np.intp)
+    cdef INDEX_t[::1] path_b = np.zeros([bt_len], dtype=np.intp)
+
+    with nogil:
+        prev_lo = 0
+        prev_hi = 0
+        for i in range(a_len):
+            row = i & 1
+            prev_row = 1 - row
+            for j in range(lo[i], hi[i]):
+                d = 0
+                for k in range(v_len):
+                    s = a[i, k] - b[j, k]
+                    if s > 0:
+                        d += s
+                    else:
+                        d -= s
+
+                # Same preference as dtw: diagonal, then left, then up
+                if i == 0 and j == 0:
+                    best = 0
+                    step = STEP_DIAG
+                elif i == 0:
+                    best = rows[row, j-1]
+                    step = STEP_LEFT
+                elif j == 0:
+                    best = rows[prev_row, j]
+                    step = STEP_UP
+                else:
+                    best = 0
+                    step = 3
+                    if prev_lo <= j - 1 < prev_hi:
+                        best = rows[prev_row, j-1]
+                        step = STEP_DIAG
+                    if j - 1 >= lo[i]:
+                        s = rows[row, j-1]
+                        if step == 3 or s < best:
+                            best = s
+                            step = STEP_LEFT
+                    if j < prev_hi:
+                        s = rows[prev_row, j]
+                        if step == 3 or s < best:
+                            best = s
+                            step = STEP_UP
+                rows[row, j] = best + d
+                steps[offsets[i] + j - lo[i]] = step
+            prev_lo = lo[i]
+            prev_hi = hi[i]
+
+        # Backtrack, as in dtw
         i = a_len - 1
         j = b_len - 1
         k = bt_len - 1
-        while i and j:
+        while i or j:
             path_a[k] = i
             path_b[k] = j
             k -= 1
-            s = cost[i-1, j-1]
-            t = cost[i, j-1]
-            u = cost[i-1, j]
-            # which is smallest?  (want to prefer s in case of tie)
-            if s <= t:  # it's not t
-                if s <= u:  # s is smallest
-                    i -= 1
-                    j -= 1
-                else:  # u is smallest
-                    i -= 1
-            else:  # it's not s
-                if t <= u:  # t is smallest
-                    j -= 1
-                else:  # s is smallest
-                    i -= 1
-        while i:
-            path_a[k] = i
-            path_b[k] = j
-            k -= 1
-            i -= 1
-        while j:
+            step = steps[offsets[i] + j - lo[i]]
+            if step == STEP_DIAG:
+                i -= 1
+                j -= 1
+            elif step == STEP_LEFT:
+                j -= 1
+            else:
+                i -= 1
+
+    dist = rows[(a_len - 1) & 1, b_len - 1] / (a_len + b_len)
+
+    return dist, np.array([path_a[k:], path_b[k:]], dtype=np.uint)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def dtw_compact(input1, input2):
+    """Like dtw, but faster and with much less memory
+
+    Features are compared in single precision, a whole row of distances
+    at a time (with loops the compiler can vectorize).
+    Only two rows of accumulated costs are kept; backtracking uses
+    2 bits per cell.
+
+    Returns (dist, path).
+    """
+    cdef F32_t[:, ::1] a = np.array(input1, dtype=np.float32, order='C')
+    # b is transposed, so that each feature is contiguous
+    cdef F32_t[:, ::1] bt = np.array(input2, dtype=np.float32).T.copy()
+
+    cdef Py_ssize_t a_len = a.shape[0]
+    cdef Py_ssize_t b_len = bt.shape[1]
+    cdef Py_ssize_t v_len = a.shape[1]
+    assert v_len == bt.shape[0]
+
+    # Four steps are packed in each byte
+    cdef cnp.uint8_t[:, ::1] steps = np.zeros(
+        [a_len, (b_len + 3) // 4], dtype=np.uint8)
+    cdef F32_t[::1] dists = np.empty([b_len], dtype=np.float32)
+    cdef F64_t[:, ::1] rows = np.empty([2, b_len], dtype=np.float64)
+
+    cdef Py_ssize_t i, j, k
+    cdef Py_ssize_t row, prev_row
+    cdef F32_t x
+    cdef F32_t *dist_ptr = &dists[0]
+    cdef F32_t *b_ptr
+    cdef F64_t s, best
+    cdef cnp.uint8_t step
+    cdef Py_ssize_t bt_len = a_len + b_len
+    cdef INDEX_t[::1] path_a = np.zeros([bt_len], dtype=np.intp)
+    cdef INDEX_t[::1] path_b = np.zeros([bt_len], dtype=np.intp)
+
+    with nogil:
+        for i in range(a_len):
+            row = i & 1
+            prev_row = 1 - row
+
+            for j in range(b_len):
+                dist_ptr[j] = 0
+            for k in range(v_len):
+                x = a[i, k]
+                b_ptr = &bt[k, 0]
+                for j in range(b_len):
+                    dist_ptr[j] += fabsf(x - b_ptr[j])
+
+            if i == 0:
+                rows[row, 0] = dists[0]
+                for j in range(1, b_len):
+                    rows[row, j] = rows[row, j-1] + dists[j]
+                    steps[i, j >> 2] |= STEP_LEFT << ((j & 3) << 1)
+                continue
+
+            rows[row, 0] = rows[prev_row, 0] + dists[0]
+            steps[i, 0] |= STEP_UP
+            for j in range(1, b_len):
+                # Same preference as dtw: diagonal, then left, then up
+                best = rows[prev_row, j-1]
+                step = STEP_DIAG
+                s = rows[row, j-1]
+                if s < best:
+                    best = s
+                    step = STEP_LEFT
+                s = rows[prev_row, j]
+                if s < best:
+                    best = s
+                    step = STEP_UP
+                rows[row, j] = best + dists[j]
+                steps[i, j >> 2] |= step << ((j & 3) << 1)
+
+        # Backtrack, as in dtw
+        i = a_len - 1
+        j = b_len - 1
+        k = bt_len - 1
+        while i or j:
             path_a[k] = i
             path_b[k] = j
             k -= 1
-            j -= 1
+            step = (steps[i, j >> 2] >> ((j & 3) << 1)) & 3
+            if step == STEP_DIAG:
+                i -= 1
+                j -= 1
+            elif step == STEP_LEFT:
+                j -= 1
+            else:
+                i -= 1
+
+    dist = rows[(a_len - 1) & 1, b_len - 1] / (a_len + b_len)
+
+    return dist, np.array([path_a[k:], path_b[k:]], dtype=np.uint)
+
+
+# Size of the square tiles dtw_parallel works on
+cdef enum:
+    TILE = 64
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _fill_tile(F64_t[:, ::1] a, F64_t[:, ::1] b, F64_t[:, ::1] cost,
+                     Py_ssize_t tile_i, Py_ssize_t tile_j) noexcept nogil:
+    cdef Py_ssize_t a_len = a.shape[0]
+    cdef Py_ssize_t b_len = b.shape[0]
+    cdef Py_ssize_t v_len = a.shape[1]
+    cdef Py_ssize_t i, j, k
+    cdef Py_ssize_t i_end = min((tile_i + 1) * TILE, a_len)
+    cdef Py_ssize_t j_end = min((tile_j + 1) * TILE, b_len)
+    cdef F64_t s, t, d
+    for i in range(tile_i * TILE, i_end):
+        for j in range(tile_j * TILE, j_end):
+            d = 0
+            for k in range(v_len):
+                s = a[i, k] - b[j, k]
+                if s > 0:
+                    d += s
+                else:
+                    d -= s
+            # Same order of operations as in dtw, to get the same sums
+            if i == 0 and j == 0:
+                cost[i, j] = d
+            elif i == 0:
+                cost[i, j] = cost[i, j-1] + d
+            elif j == 0:
+                cost[i, j] = cost[i-1, j] + d
+            else:
+                s = cost[i-1, j-1]
+                t = cost[i, j-1]
+                if t < s:
+                    s = t
+                t = cost[i-1, j]
+                if t < s:
+                    s = t
+                cost[i, j] = d + s
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def dtw_parallel(input1, input2, int num_threads=0):
+    """Like dtw, but fill the cost matrix using several threads
+
+    The matrix is split into square tiles. Tiles on the same
+    anti-diagonal don't depend on each other, so each anti-diagonal
+    of tiles is filled in parallel.
+    The result is the same as dtw's. ``num_threads`` defaults to the
+    number of CPUs.
+    """
+    cdef F64_t[:, ::1] a = np.array(input1, dtype=np.float64, order='C')
+    cdef F64_t[:, ::1] b = np.array(input2, dtype=np.float64, order='C')
+
+    cdef Py_ssize_t a_len = a.shape[0]
+    cdef Py_ssize_t b_len = b.shape[0]
+    assert a.shape[1] == b.shape[1]
+    cdef F64_t[:, ::1] cost = np.empty([a_len, b_len], dtype=np.float64)
+    cdef Py_ssize_t bt_len = a_len + b_len
+    cdef INDEX_t[::1] path_a = np.zeros([bt_len], dtype=np.intp)
+    cdef INDEX_t[::1] path_b = np.zeros([bt_len], dtype=np.intp)
+
+    cdef Py_ssize_t tiles_a = (a_len + TILE - 1) // TILE
+    cdef Py_ssize_t tiles_b = (b_len + TILE - 1) // TILE
+    cdef Py_ssize_t diagonal, tile_i, first, last, k
+    if num_threads <= 0:
+        num_threads = os.cpu_count() or 1
+
+    with nogil:
+        for diagonal in range(tiles_a + tiles_b - 1):
+            first = max(0, diagonal - tiles_b + 1)
+            last = min(diagonal + 1, tiles_a)
+            for tile_i in prange(first, last, num_threads=num_threads,
+                                 schedule='dynamic'):
+                _fill_tile(a, b, cost, tile_i, diagonal - tile_i)
+
+        k = _backtrack(cost, path_a, path_b)
 
     dist = cost[a_len-1, b_len-1] / (a_len + b_len)
 
@@ -1,4 +1,8 @@
+import os
+import tempfile
+
 from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
 
 from Cython.Build import cythonize
 import numpy
@@ -8,6 +12,48 @@ extensions = [
               include_dirs=[numpy.get_include()]),
 ]
 
+OPENMP_TEST = """
+#include <omp.h>
+int main(void) { return omp_get_max_threads() < 0; }
+"""
+
+
+def openmp_flags(compiler):
+    """Return (compile, link) flags for OpenMP, or None if unsupported"""
+    if compiler.compiler_type == 'msvc':
+        flags = ['/openmp'], []
+    else:
+        flags = ['-fopenmp'], ['-fopenmp']
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source = os.path.join(tmpdir, 'openmp_test.c')
+        with open(source, 'w') as f:
+            f.write(OPENMP_TEST)
+        try:
+            objects = compiler.compile([source], output_dir=tmpdir,
+                                       extra_postargs=flags[0])
+            compiler.link_executable(objects, 'openmp_test',
+                                     output_dir=tmpdir,
+                                     extra_postargs=flags[1])
+        except Exception:
+            return None
+    return flags
+
+
+class BuildExt(build_ext):
+    """Build with OpenMP if the compiler supports it
+
+    Without it, the parallel DTW runs in one thread.
+    """
+    def build_extensions(self):
+        flags = openmp_flags(self.compiler)
+        if flags is None:
+            print('OpenMP not available; building without it')
+        else:
+            for ext in self.extensions:
+                ext.extra_compile_args.extend(flags[0])
+                ext.extra_link_args.extend(flags[1])
+        super().build_extensions()
+
 
 setup(
     name='talk_video_maker',
@@ -36,7 +82,11 @@ setup(
         # /usr/bin/inkscape
         # /usr/bin/ffmpeg
     ],
+    extras_require={
+        'cairo': ['cairosvg'],
+    },
     setup_requires = ['cython'],
 
     ext_modules = cythonize(extensions),
+    cmdclass = {'build_ext': BuildExt},
 )
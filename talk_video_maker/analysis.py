@@ -0,0 +1,469 @@
+"""Audio analysis, computed while ffmpeg streams the audio
+
+The audio of each video is decoded once, and gives:
+
+- MFCC frames, for syncing,
+- EBU R128 loudness, for normalization,
+- a map of where there's speech, for syncing and trimming.
+
+Samples are read from an ffmpeg pipe in fixed-size blocks, so memory use
+doesn't depend on the length of the recording and no WAV file is written.
+MFCCs are computed the way ``librosa.feature.mfcc`` does by default
+(centered frames, zero-padded), except that the decibel values
+are not clipped relative to the loudest frame, which can't be known
+in advance.
+
+Blocks can be processed by a pool of worker processes; set the
+TALK_VIDEO_MAKER_ANALYSIS_WORKERS environment variable to change
+their number (1 computes everything in-process).
+"""
+
+import collections
+from concurrent.futures import ProcessPoolExecutor
+import functools
+import json
+import os
+import subprocess
+import threading
+
+import librosa
+import numpy
+import scipy.fftpack
+import scipy.ndimage
+import scipy.signal
+
+from . import objects
+from .objects import hash_bytes
+
+SAMPLE_RATE = 22050
+N_FFT = 2048
+HOP_LENGTH = 512
+N_MELS = 128
+N_MFCC = 10
+
+FEATURE_DTYPE = numpy.float32
+
+# Number of MFCC frames computed in one block
+BLOCK_FRAMES = 2048
+# Number of blocks that can be waiting for a worker
+MAX_PENDING_BLOCKS = 8
+
+# Voice activity detection: frames louder than this point between the
+# noise floor (0) and the speech level (1) count as speech.
+# The levels are percentiles of the first MFCC (log energy).
+VAD_PERCENTILES = 10, 90
+VAD_THRESHOLD = 0.3
+# Speech regions are extended by this much on both sides
+VAD_HANGOVER = 0.5  # seconds
+
+# EBU R128 loudness. Energies of K-weighted samples are kept for short
+# blocks; 400 ms gating blocks and 3 s short-term windows are made of them.
+LOUDNESS_BLOCK = 0.1  # seconds
+LOUDNESS_GATE_BLOCKS = 4
+LOUDNESS_SHORT_TERM_BLOCKS = 30
+LOUDNESS_ABSOLUTE_GATE = -70  # LUFS
+LOUDNESS_RELATIVE_GATE = -10  # LU, for integrated loudness
+LOUDNESS_RANGE_GATE = -20  # LU, for loudness range
+LOUDNESS_RANGE_PERCENTILES = 10, 95
+TARGET_LOUDNESS = -23  # LUFS
+
+# Speech kept around the talk by trimmed_to_speech
+SPEECH_TRIM_MARGIN = 2  # seconds
+
+ANALYSIS_WORKERS = int(os.environ.get('TALK_VIDEO_MAKER_ANALYSIS_WORKERS',
+                                      os.cpu_count() or 1))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the process pool for analysis, or None to work in-process"""
+    global _executor
+    if ANALYSIS_WORKERS <= 1:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(ANALYSIS_WORKERS)
+        return _executor
+
+
+@functools.lru_cache()
+def _mel_basis():
+    return librosa.filters.mel(sr=SAMPLE_RATE, n_fft=N_FFT, n_mels=N_MELS)
+
+
+@functools.lru_cache()
+def _window():
+    # Periodic Hann window, as used by librosa
+    return 0.5 - 0.5 * numpy.cos(2 * numpy.pi * numpy.arange(N_FFT) / N_FFT)
+
+
+def mfcc_frames(samples):
+    """Compute MFCC frames for samples that start at a frame boundary
+
+    Only whole frames are computed: the result has
+    ``(len(samples) - N_FFT) // HOP_LENGTH + 1`` rows of N_MFCC values.
+    """
+    count = (len(samples) - N_FFT) // HOP_LENGTH + 1
+    if count <= 0:
+        return numpy.zeros((0, N_MFCC))
+    frames = numpy.lib.stride_tricks.as_strided(
+        samples, shape=(count, N_FFT),
+        strides=(samples.strides[0] * HOP_LENGTH, samples.strides[0]))
+    spectrum = numpy.abs(numpy.fft.rfft(frames * _window(), axis=1)) ** 2
+    mel = _mel_basis().dot(spectrum.T)
+    db = 10 * numpy.log10(numpy.maximum(mel, 1e-10))
+    mfcc = scipy.fftpack.dct(db, axis=0, type=2, norm='ortho')[:N_MFCC]
+    return mfcc.T
+
+
+def speech_mask(frames):
+    """Return a boolean array marking MFCC frames that contain speech
+
+    This is a simple energy detector: it also marks music, noise, etc.,
+    if it's much louder than the quiet parts of the recording.
+    """
+    energy = numpy.asarray(frames[:, 0], dtype=numpy.float64)
+    if not len(energy):
+        return numpy.zeros(0, dtype=bool)
+    floor, level = numpy.percentile(energy, VAD_PERCENTILES)
+    mask = energy > floor + (level - floor) * VAD_THRESHOLD
+    hangover = int(VAD_HANGOVER * SAMPLE_RATE / HOP_LENGTH)
+    if hangover:
+        mask = scipy.ndimage.maximum_filter1d(
+            mask.astype(numpy.uint8), 2 * hangover + 1) > 0
+    return mask
+
+
+def speech_segments(mask):
+    """Return (start, end) times of speech, in seconds, from a speech mask"""
+    edges = numpy.diff(numpy.concatenate([[0], mask.astype(numpy.int8), [0]]))
+    starts, = numpy.nonzero(edges == 1)
+    ends, = numpy.nonzero(edges == -1)
+    scale = HOP_LENGTH / SAMPLE_RATE
+    return [(float(start * scale), float(end * scale))
+            for start, end in zip(starts, ends)]
+
+
+def k_weighting(sample_rate):
+    """Return the ITU-R BS.1770 K-weighting filter, as second-order sections
+
+    The filter is designed for the given rate, as in libebur128.
+    """
+    # High shelf (the "pre-filter")
+    f0 = 1681.974450955533
+    gain = 3.999843853973347
+    q = 0.7071752369554196
+    k = numpy.tan(numpy.pi * f0 / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = [(vh + vb * k / q + k * k) / a0,
+             2 * (k * k - vh) / a0,
+             (vh - vb * k / q + k * k) / a0,
+             1,
+             2 * (k * k - 1) / a0,
+             (1 - k / q + k * k) / a0]
+    # High pass (the "RLB" filter)
+    f0 = 38.13547087602444
+    q = 0.5003270373238773
+    k = numpy.tan(numpy.pi * f0 / sample_rate)
+    a0 = 1 + k / q + k * k
+    high_pass = [1, -2, 1,
+                 1,
+                 2 * (k * k - 1) / a0,
+                 (1 - k / q + k * k) / a0]
+    return numpy.array([shelf, high_pass])
+
+
+class LoudnessMeter:
+    """Measure the loudness of streamed samples, following EBU R128
+
+    Samples are K-weighted, and their mean square is kept for each
+    LOUDNESS_BLOCK; ``stats`` computes gated loudness from these.
+
+    Only one channel is measured (here, the mono mix that is analysed),
+    so for stereo input the result can differ from a standard meter
+    by up to 3 LU.
+    """
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.sos = k_weighting(sample_rate)
+        self.state = numpy.zeros((len(self.sos), 2))
+        self.block_samples = int(round(sample_rate * LOUDNESS_BLOCK))
+        self.leftover = numpy.zeros(0)
+        self.energies = []
+
+    def add(self, samples):
+        weighted, self.state = scipy.signal.sosfilt(
+            self.sos, numpy.asarray(samples, dtype=numpy.float64),
+            zi=self.state)
+        weighted = numpy.concatenate([self.leftover, weighted])
+        count = len(weighted) // self.block_samples
+        end = count * self.block_samples
+        blocks = weighted[:end].reshape(count, self.block_samples)
+        self.energies.extend((blocks ** 2).mean(axis=1))
+        self.leftover = weighted[end:]
+
+    def stats(self):
+        """Return integrated loudness (LUFS) and loudness range (LU)
+
+        Integrated loudness is None if all of the audio is below
+        the absolute gate.
+        """
+        energies = numpy.array(self.energies)
+        return {
+            'integrated': integrated_loudness(energies),
+            'range': loudness_range(energies),
+        }
+
+
+def _loudness(power):
+    return -0.691 + 10 * numpy.log10(numpy.maximum(power, 1e-20))
+
+
+def _window_power(energies, size):
+    """Mean energy of each run of ``size`` consecutive blocks"""
+    if len(energies) < size:
+        return numpy.zeros(0)
+    sums = numpy.concatenate([[0], numpy.cumsum(energies)])
+    return (sums[size:] - sums[:-size]) / size
+
+
+def integrated_loudness(energies):
+    """Gated loudness (LUFS) from block energies, or None if all is silent"""
+    power = _window_power(energies, LOUDNESS_GATE_BLOCKS)
+    power = power[_loudness(power) > LOUDNESS_ABSOLUTE_GATE]
+    if not len(power):
+        return None
+    threshold = _loudness(power.mean()) + LOUDNESS_RELATIVE_GATE
+    power = power[_loudness(power) > threshold]
+    return float(_loudness(power.mean()))
+
+
+def loudness_range(energies):
+    """Loudness range (LU) from block energies, as in EBU Tech 3342"""
+    power = _window_power(energies, LOUDNESS_SHORT_TERM_BLOCKS)
+    power = power[_loudness(power) > LOUDNESS_ABSOLUTE_GATE]
+    if not len(power):
+        return 0.0
+    threshold = _loudness(power.mean()) + LOUDNESS_RANGE_GATE
+    loudness = _loudness(power)
+    low, high = numpy.percentile(loudness[loudness > threshold],
+                                 LOUDNESS_RANGE_PERCENTILES)
+    return float(high - low)
+
+
+def iter_sample_blocks(stream, block_samples):
+    """Read s16le samples from a binary stream, as float arrays
+
+    Each array has block_samples samples, except possibly the last.
+    """
+    leftover = b''
+    while True:
+        data = stream.read(block_samples * 2 - len(leftover))
+        if not data:
+            break
+        data = leftover + data
+        usable = len(data) - len(data) % 2
+        leftover = data[usable:]
+        if usable:
+            samples = numpy.frombuffer(data[:usable], dtype='<i2')
+            yield samples.astype(numpy.float32) / 32768
+
+
+def iter_frame_inputs(sample_blocks, block_frames=BLOCK_FRAMES):
+    """Split streamed samples into overlapping chunks for mfcc_frames
+
+    Each chunk holds exactly block_frames frames (the last one may have
+    fewer). Padding is added at both ends, as for librosa's centered
+    frames.
+    """
+    padding = numpy.zeros(N_FFT // 2, dtype=numpy.float32)
+    chunk_len = (block_frames - 1) * HOP_LENGTH + N_FFT
+    step = block_frames * HOP_LENGTH
+    buffer = padding
+    for block in sample_blocks:
+        buffer = numpy.concatenate([buffer, block])
+        while len(buffer) >= chunk_len:
+            yield buffer[:chunk_len]
+            buffer = buffer[step:]
+    buffer = numpy.concatenate([buffer, padding])
+    if len(buffer) >= N_FFT:
+        yield buffer
+
+
+def _metered(sample_blocks, meter):
+    for block in sample_blocks:
+        meter.add(block)
+        yield block
+
+
+def iter_mfcc(video, executor=None, meter=None):
+    """Yield arrays of MFCC frames (one row per frame) for a video's audio
+
+    If a LoudnessMeter is given, the samples are also fed to it.
+    """
+    if executor is None:
+        executor = get_executor()
+    process = video.open_raw_audio(SAMPLE_RATE)
+    try:
+        sample_blocks = iter_sample_blocks(
+            process.stdout, BLOCK_FRAMES * HOP_LENGTH)
+        if meter is not None:
+            sample_blocks = _metered(sample_blocks, meter)
+        chunks = iter_frame_inputs(sample_blocks)
+        if executor is None:
+            for chunk in chunks:
+                yield mfcc_frames(chunk)
+        else:
+            pending = collections.deque()
+            for chunk in chunks:
+                if len(pending) >= MAX_PENDING_BLOCKS:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(mfcc_frames, chunk))
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, process.args)
+
+
+def compute_mfcc(video, executor=None):
+    """Return the MFCC frames of a video's audio, as a (frames, N_MFCC) array"""
+    blocks = list(iter_mfcc(video, executor))
+    if not blocks:
+        return numpy.zeros((0, N_MFCC))
+    return numpy.concatenate(blocks)
+
+
+class AudioAnalysis(objects.Object):
+    """Analysis of a video's audio, from a single decode
+
+    MFCC frames are saved as a .npy file; loudness and the speech map
+    go to a JSON file next to it (see ``summary``).
+
+    The analysis only depends on the audio, so one file serves any number
+    of sync pairs. ``frames`` is memory-mapped: slicing it only reads
+    the needed part.
+    """
+    ext = '.npy'
+    summary_ext = '.json'
+
+    def __init__(self, video):
+        self.video = video
+        self.hash = hash_bytes(
+            type(self).__name__.encode('utf-8'),
+            video.mono_audio().hash.encode('utf-8'),
+            repr((SAMPLE_RATE, N_FFT, HOP_LENGTH, N_MELS, N_MFCC,
+                  numpy.dtype(FEATURE_DTYPE).str)).encode('utf-8'),
+            repr((VAD_PERCENTILES, VAD_THRESHOLD, VAD_HANGOVER,
+                  LOUDNESS_BLOCK)).encode('utf-8'))
+
+    def save_to(self, filename):
+        # The number of frames isn't known in advance: write them to
+        # a raw file first, then copy them under a .npy header
+        raw_filename = filename + '.raw'
+        meter = LoudnessMeter()
+        count = 0
+        try:
+            with open(raw_filename, 'wb') as f:
+                for block in iter_mfcc(self.video, meter=meter):
+                    f.write(block.astype(FEATURE_DTYPE).tobytes())
+                    count += len(block)
+            result = numpy.lib.format.open_memmap(
+                filename, mode='w+', dtype=FEATURE_DTYPE,
+                shape=(count, N_MFCC))
+            if count:
+                raw = numpy.memmap(raw_filename, dtype=FEATURE_DTYPE,
+                                   mode='r', shape=(count, N_MFCC))
+                step = BLOCK_FRAMES * MAX_PENDING_BLOCKS
+                for start in range(0, count, step):
+                    result[start:start+step] = raw[start:start+step]
+                del raw
+            result.flush()
+            self._save_summary(meter, speech_mask(result))
+            del result
+        finally:
+            try:
+                os.unlink(raw_filename)
+            except FileNotFoundError:
+                pass
+
+    def _save_summary(self, meter, mask):
+        summary_filename = self.get_filename(ext=self.summary_ext)
+        with open(summary_filename + '~', 'w') as f:
+            json.dump({
+                'duration': len(meter.energies) * LOUDNESS_BLOCK,
+                'loudness': meter.stats(),
+                'speech': speech_segments(mask),
+            }, f)
+        os.rename(summary_filename + '~', summary_filename)
+
+    @property
+    def frames(self):
+        return objects.registry.payload(
+            (self.hash, 'frames'),
+            lambda: numpy.load(self.filename, mmap_mode='r'))
+
+    @property
+    def speech_mask(self):
+        return objects.registry.payload(
+            (self.hash, 'speech'), lambda: speech_mask(self.frames),
+            size=len)
+
+    @property
+    def summary(self):
+        """Loudness and speech map, as a dict
+
+        Keys are ``duration`` (seconds), ``loudness`` (see
+        LoudnessMeter.stats) and ``speech`` ((start, end) times of speech).
+        """
+        return objects.registry.payload(
+            (self.hash, 'summary'), self._read_summary, size=10000)
+
+    def _read_summary(self):
+        self.filename
+        summary_filename = self.get_filename(ext=self.summary_ext)
+        if not os.path.exists(summary_filename):
+            # Only the frames were kept (e.g. in the fast cache); redo it all
+            self._save_to_disk(self.get_filename())
+        with open(summary_filename) as f:
+            return json.load(f)
+
+    @property
+    def loudness(self):
+        return self.summary['loudness']
+
+    @property
+    def speech(self):
+        return [tuple(segment) for segment in self.summary['speech']]
+
+
+def get_analysis(video):
+    return objects.registry.intern(AudioAnalysis(video))
+
+
+def loudness_normalized(video, target=TARGET_LOUDNESS):
+    """Return the video with its audio at the target loudness (LUFS)"""
+    loudness = get_analysis(video).loudness['integrated']
+    if loudness is None:
+        return video
+    return video.with_volume(target - loudness)
+
+
+def trimmed_to_speech(video, margin=SPEECH_TRIM_MARGIN):
+    """Return the video without silence at the start and end
+
+    ``margin`` seconds are kept around the first and last speech.
+    """
+    speech = get_analysis(video).speech
+    if not speech:
+        return video
+    start = max(0, speech[0][0] - margin)
+    end = min(video.duration, speech[-1][1] + margin)
+    if start > 0:
+        video = video.trimmed(start=start)
+    return video.trimmed(end=end - start)
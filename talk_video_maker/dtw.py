@@ -0,0 +1,370 @@
+"""Dynamic time warping, with interchangeable backends
+
+The Cython kernels (in ``cdtw.pyx``) are the fastest, but they need
+a compiled extension. A NumPy implementation is always available.
+
+All backends find the same kind of path. The full DTW path goes from
+(0, 0) to the last cells of both sequences, and its cost is the L1
+distance of the features. Corridor DTW only considers cells where
+``lo[i] <= j < hi[i]``.
+Functions return ``(dist, path)``, where path is a 2×N array of indices.
+
+The backend is picked automatically: the fastest one for the size of
+the problem, based on a quick benchmark. Backends that would need more
+than DTW_MAX_MEMORY for the problem are not considered. The
+TALK_VIDEO_MAKER_DTW_BACKEND environment variable can force a particular
+one, and TALK_VIDEO_MAKER_DTW_THREADS sets the number of threads of
+the parallel backend.
+"""
+
+import os
+import time
+
+import numpy
+
+try:
+    from . import cdtw
+except ImportError:
+    # The extension wasn't compiled
+    cdtw = None
+
+# Problems larger than this are benchmarked at this size
+BENCHMARK_MAX_SIZE = 256
+BENCHMARK_FEATURES = 10
+
+# Memory a backend may use for one problem
+DTW_MAX_MEMORY = int(os.environ.get('TALK_VIDEO_MAKER_DTW_MAX_MEMORY',
+                                    256 * 2**20))
+# Threads for the parallel backend (0: one per CPU)
+DTW_THREADS = int(os.environ.get('TALK_VIDEO_MAKER_DTW_THREADS', 0))
+
+# Backtracking steps, as in cdtw
+STEP_DIAG = 0
+STEP_LEFT = 1  # to (i, j-1)
+STEP_UP = 2  # to (i-1, j)
+
+
+class DTWBackend:
+    name = None
+
+    def is_available(self):
+        return True
+
+    def memory(self, kind, size):
+        """Approximate memory needed for a size×size problem, in bytes
+
+        Corridor problems only use memory proportional to the corridor,
+        so they're not limited.
+        """
+        return 0
+
+    def full(self, input1, input2):
+        raise NotImplementedError()
+
+    def corridor(self, input1, input2, lo, hi):
+        raise NotImplementedError()
+
+
+class CythonBackend(DTWBackend):
+    name = 'cython'
+
+    def is_available(self):
+        return cdtw is not None
+
+    def memory(self, kind, size):
+        if kind == 'full':
+            # 2 bits per cell
+            return size * size // 4
+        return 0
+
+    def full(self, input1, input2):
+        return cdtw.dtw_compact(input1, input2)
+
+    def corridor(self, input1, input2, lo, hi):
+        return cdtw.dtw_corridor(input1, input2, lo, hi)
+
+
+class ParallelCythonBackend(CythonBackend):
+    name = 'cython-parallel'
+
+    def __init__(self, num_threads=DTW_THREADS):
+        self.num_threads = num_threads
+
+    def memory(self, kind, size):
+        if kind == 'full':
+            # The whole float64 cost matrix
+            return size * size * 8
+        return 0
+
+    def full(self, input1, input2):
+        dist, cost, path = cdtw.dtw_parallel(input1, input2,
+                                             self.num_threads)
+        return dist, path
+
+
+class NumpyBackend(DTWBackend):
+    name = 'numpy'
+
+    # Number of distances computed at once
+    block_size = 1 << 22
+
+    def memory(self, kind, size):
+        if kind == 'full':
+            return size * size * 8
+        return 0
+
+    def full(self, input1, input2):
+        a = numpy.asarray(input1, dtype=numpy.float64)
+        b = numpy.asarray(input2, dtype=numpy.float64)
+        a_len = len(a)
+        b_len = len(b)
+        # Accumulated costs, with an extra row and column in front
+        acc = numpy.full((a_len + 1, b_len + 1), numpy.inf)
+        acc[0, 0] = 0
+        cost = acc[1:, 1:]
+        block_rows = max(1, self.block_size // max(b_len, 1))
+        for start in range(0, a_len, block_rows):
+            cost[start:start+block_rows] = self.distances(
+                a[start:start+block_rows], b)
+
+        # Cells on an anti-diagonal only depend on earlier ones
+        flat = acc.ravel()
+        stride = b_len + 1
+        for diagonal in range(a_len + b_len - 1):
+            i = numpy.arange(max(0, diagonal - b_len + 1),
+                             min(diagonal, a_len - 1) + 1)
+            j = diagonal - i
+            index = (i + 1) * stride + (j + 1)
+            # Same preference as cdtw: diagonal, then left, then up
+            best = flat[index - stride - 1]
+            best = numpy.where(flat[index - 1] < best,
+                               flat[index - 1], best)
+            best = numpy.where(flat[index - stride] < best,
+                               flat[index - stride], best)
+            flat[index] += best
+
+        path = [[], []]
+        i = a_len - 1
+        j = b_len - 1
+        while i or j:
+            path[0].append(i)
+            path[1].append(j)
+            diag = acc[i, j]
+            left = acc[i + 1, j]
+            up = acc[i, j + 1]
+            if diag <= left and diag <= up:
+                i -= 1
+                j -= 1
+            elif left <= up and left < diag:
+                j -= 1
+            else:
+                i -= 1
+        return (acc[a_len, b_len] / (a_len + b_len),
+                _finish_path(path))
+
+    def corridor(self, input1, input2, lo, hi):
+        a = numpy.asarray(input1, dtype=numpy.float64)
+        b = numpy.asarray(input2, dtype=numpy.float64)
+        prev = None
+        prev_lo = prev_hi = 0
+        all_steps = []
+        for i, (row_lo, row_hi) in enumerate(zip(lo, hi)):
+            cost = self.distances(a[i:i+1], b[row_lo:row_hi])[0]
+            width = row_hi - row_lo
+            diag = numpy.full(width, numpy.inf)
+            up = numpy.full(width, numpy.inf)
+            if prev is None:
+                diag[0] = 0
+            else:
+                # prev[j - prev_lo] is the accumulated cost at (i-1, j)
+                cols = numpy.arange(row_lo, row_hi)
+                has_diag = (cols - 1 >= prev_lo) & (cols - 1 < prev_hi)
+                diag[has_diag] = prev[cols[has_diag] - 1 - prev_lo]
+                has_up = cols < prev_hi
+                up[has_up] = prev[cols[has_up] - prev_lo]
+            vertical = numpy.minimum(diag, up)
+            # cur[j] = cost[j] + min(vertical[j], cur[j-1]), as a scan:
+            # the path enters the row at some k <= j, then goes left
+            sums = numpy.cumsum(cost)
+            cur = sums + numpy.minimum.accumulate(vertical + cost - sums)
+            left = numpy.concatenate([[numpy.inf], cur[:-1]])
+            # Same preference as cdtw: diagonal, then left, then up
+            steps = numpy.full(width, STEP_DIAG, dtype=numpy.uint8)
+            best = diag
+            steps[left < best] = STEP_LEFT
+            best = numpy.minimum(best, left)
+            steps[up < best] = STEP_UP
+            all_steps.append(steps)
+            prev = cur
+            prev_lo, prev_hi = row_lo, row_hi
+
+        path = [[], []]
+        i = len(a) - 1
+        j = len(b) - 1
+        while i or j:
+            path[0].append(i)
+            path[1].append(j)
+            step = all_steps[i][j - lo[i]]
+            if step == STEP_DIAG:
+                i -= 1
+                j -= 1
+            elif step == STEP_LEFT:
+                j -= 1
+            else:
+                i -= 1
+        return prev[-1] / (len(a) + len(b)), _finish_path(path)
+
+    @staticmethod
+    def distances(a, b):
+        """L1 distances between all rows of a and all rows of b"""
+        result = numpy.zeros((len(a), len(b)))
+        # Sum feature by feature, in the same order as cdtw
+        for k in range(a.shape[1]):
+            result += numpy.abs(a[:, k, numpy.newaxis] - b[numpy.newaxis, :, k])
+        return result
+
+
+def _finish_path(path):
+    """Convert a backtracked path (from the end) to the usual array"""
+    # Like cdtw, the path starts with (0, 0)
+    path[0].append(0)
+    path[1].append(0)
+    return numpy.array([path[0][::-1], path[1][::-1]], dtype=numpy.uint)
+
+
+CYTHON = CythonBackend()
+CYTHON_PARALLEL = ParallelCythonBackend()
+NUMPY = NumpyBackend()
+
+BACKENDS = [CYTHON, CYTHON_PARALLEL, NUMPY]
+
+
+def get_backend(name):
+    for backend in BACKENDS:
+        if backend.name == name:
+            return backend
+    raise LookupError('unknown DTW backend {!r}'.format(name))
+
+
+def available_backends(kind=None, size=None):
+    """Return backends that can be used (for a problem, if given)
+
+    With ``kind`` and ``size``, backends that need more than
+    DTW_MAX_MEMORY are left out -- unless all of them do, in which case
+    the one that needs least is returned.
+    """
+    backends = [backend for backend in BACKENDS if backend.is_available()]
+    if kind is None:
+        return backends
+    fitting = [backend for backend in backends
+               if backend.memory(kind, size) <= DTW_MAX_MEMORY]
+    if not fitting:
+        fitting = [min(backends,
+                       key=lambda backend: backend.memory(kind, size))]
+    return fitting
+
+
+_fastest = {}
+
+
+def choose_backend(kind, size):
+    """Return the backend to use for a problem
+
+    ``kind`` is 'full' or 'corridor'; ``size`` is the length of the longer
+    sequence. The fastest backend (of those that fit in DTW_MAX_MEMORY)
+    is chosen by benchmarking, once for each power of two.
+    """
+    forced = os.environ.get('TALK_VIDEO_MAKER_DTW_BACKEND')
+    if forced:
+        return get_backend(forced)
+    backends = available_backends(kind, int(size))
+    if len(backends) == 1:
+        return backends[0]
+    bits = max(int(size) - 1, 0).bit_length()
+    key = kind, bits, tuple(backend.name for backend in backends)
+    try:
+        return _fastest[key]
+    except KeyError:
+        pass
+    timings = benchmark(kind, min(1 << bits, BENCHMARK_MAX_SIZE), backends)
+    fastest = min(timings, key=timings.get)
+    _fastest[key] = fastest
+    return fastest
+
+
+def benchmark(kind, size, backends=None, repeat=3):
+    """Time backends on random data; return {backend: best time}"""
+    if backends is None:
+        backends = available_backends()
+    random = numpy.random.RandomState(0)
+    input1 = random.normal(size=(size, BENCHMARK_FEATURES))
+    input2 = random.normal(size=(size, BENCHMARK_FEATURES))
+    lo, hi = band_limits(size, size, max(size // 8, 1))
+    timings = {}
+    for backend in backends:
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            if kind == 'full':
+                backend.full(input1, input2)
+            else:
+                backend.corridor(input1, input2, lo, hi)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings[backend] = best
+    return timings
+
+
+def dtw(input1, input2, backend=None):
+    """Full DTW; returns (dist, path)"""
+    if backend is None:
+        backend = choose_backend('full', max(len(input1), len(input2)))
+    return backend.full(input1, input2)
+
+
+def dtw_corridor(input1, input2, lo, hi, backend=None):
+    """DTW within a corridor; returns (dist, path)
+
+    The corridor limits are adjusted with connect_corridor first.
+    """
+    lo, hi = connect_corridor(lo, hi, len(input2))
+    if backend is None:
+        backend = choose_backend('corridor', max(len(input1), len(input2)))
+    return backend.corridor(input1, input2, lo, hi)
+
+
+def dtw_banded(input1, input2, band, slope=1.0, offset=0.0, backend=None):
+    """DTW within a band around the line j = offset + slope * i"""
+    lo, hi = band_limits(len(input1), len(input2), band, slope, offset)
+    return dtw_corridor(input1, input2, lo, hi, backend=backend)
+
+
+def connect_corridor(lo, hi, b_len):
+    """Adjust corridor limits so that a DTW path can pass through
+
+    Row i of the corridor covers columns lo[i] <= j < hi[i].
+    The result starts at (0, 0), ends at the last column, and consecutive
+    rows overlap or touch diagonally.
+    """
+    lo = numpy.array(lo, dtype=numpy.intp)
+    hi = numpy.array(hi, dtype=numpy.intp)
+    lo[0] = 0
+    hi[-1] = b_len
+    hi = numpy.maximum.accumulate(numpy.clip(hi, 1, b_len))
+    lo = numpy.minimum.accumulate(
+        numpy.clip(lo, 0, b_len - 1)[::-1])[::-1].copy()
+    lo[1:] = numpy.minimum(lo[1:], hi[:-1])
+    hi = numpy.maximum.accumulate(numpy.maximum(hi, lo + 1))
+    return lo, hi
+
+
+def band_limits(a_len, b_len, band, slope=1.0, offset=0.0):
+    """Corridor limits for a band around the line j = offset + slope * i
+
+    ``band`` is the number of cells on each side of the line.
+    """
+    centre = offset + slope * numpy.arange(a_len)
+    lo = numpy.floor(centre - band)
+    hi = numpy.ceil(centre + band) + 1
+    return connect_corridor(lo, hi, b_len)
@@ -0,0 +1,218 @@
+"""Running Inkscape commands through a pool of long-lived processes
+
+Inkscape takes seconds to start. Rather than launching it for every export
+or query, we keep a few processes running in shell mode (``inkscape
+--shell``), and feed them command lines.
+Consecutive commands for the same SVG can be sent to one process as a batch.
+"""
+
+import contextlib
+import os
+import queue
+import shlex
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .objects import run
+
+INKSCAPE_WORKERS = int(os.environ.get('TALK_VIDEO_MAKER_INKSCAPE_WORKERS',
+                                      os.cpu_count() or 1))
+
+
+class InkscapeWorker:
+    def __init__(self):
+        print('Starting', ['inkscape', '--shell'])
+        self.process = subprocess.Popen(
+            ['inkscape', '--shell'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self._read_until_prompt()
+
+    def _read_until_prompt(self):
+        fd = self.process.stdout.fileno()
+        data = b''
+        while True:
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                raise RuntimeError('Inkscape shell exited unexpectedly')
+            data += chunk
+            stripped = data.rstrip(b' ')
+            if stripped == b'>' or stripped.endswith(b'\n>'):
+                return stripped[:-1]
+
+    def run(self, args):
+        print('Running', ['inkscape'] + list(args), '(shell)')
+        line = ' '.join(shlex.quote(str(a)) for a in args)
+        self.process.stdin.write(line.encode('utf-8') + b'\n')
+        self.process.stdin.flush()
+        output = self._read_until_prompt()
+        # The banner and prompt share stdout with command output; drop the
+        # leading newline left over from the previous prompt
+        return output.lstrip(b'\n')
+
+    def close(self):
+        try:
+            self.process.stdin.write(b'quit\n')
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.wait()
+
+    def kill(self):
+        """Stop a worker whose output might be out of sync with commands"""
+        self.process.kill()
+        self.process.wait()
+
+
+class InkscapePool:
+    def __init__(self, size):
+        self.size = size
+        self._idle = queue.Queue()
+        self._started = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.executor = ThreadPoolExecutor(size)
+        self.shell_available = True
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            start = self._started < self.size and self.shell_available
+            if start:
+                self._started += 1
+        if start:
+            try:
+                return InkscapeWorker()
+            except (OSError, RuntimeError):
+                with self._lock:
+                    self._started -= 1
+                    self.shell_available = False
+                return None
+        if not self.shell_available:
+            return None
+        return self._idle.get()
+
+    @contextlib.contextmanager
+    def session(self):
+        """Use one worker for all commands run in the current thread
+
+        The worker is only acquired when the first command is run.
+        """
+        if getattr(self._local, 'in_session', False):
+            yield
+            return
+        self._local.in_session = True
+        self._local.worker = None
+        try:
+            yield
+        except BaseException:
+            # The worker might be in an unknown state (even after
+            # KeyboardInterrupt), so it's not reused
+            self._discard()
+            raise
+        else:
+            worker = self._local.worker
+            if worker is not None:
+                self._idle.put(worker)
+        finally:
+            self._local.in_session = False
+            self._local.worker = None
+
+    def _discard(self):
+        worker = self._local.worker
+        if worker is not None:
+            self._local.worker = None
+            worker.kill()
+            with self._lock:
+                self._started -= 1
+
+    def run(self, args, check=None):
+        """Run an Inkscape command, return its output
+
+        If given, ``check`` is called with the output. If it raises
+        ValueError, the shell might have failed without saying so: the
+        worker is discarded, and the command is run again in a separate
+        Inkscape process (whose output must pass the check).
+        """
+        with self.session():
+            worker = self._local.worker
+            if worker is None:
+                worker = self._local.worker = self._acquire()
+            if worker is not None:
+                output = worker.run(args)
+                if check is None:
+                    return output
+                try:
+                    check(output)
+                    return output
+                except ValueError as e:
+                    print('Inkscape shell: {}; running separately'.format(e))
+                    self._discard()
+            output = run(['inkscape'] + list(args))
+            if check is not None:
+                check(output)
+            return output
+
+    def map_batches(self, func, batches):
+        """Call func on each batch, in parallel; each batch gets one worker
+
+        Called from within a batch (e.g. for a nested export), the batches
+        are run in the current thread, with its worker, since the pool's
+        threads might all be waiting for this one.
+        """
+        if getattr(self._local, 'in_session', False):
+            return [func(batch) for batch in batches]
+
+        def run_batch(batch):
+            with self.session():
+                return func(batch)
+        return list(self.executor.map(run_batch, batches))
+
+
+pool = InkscapePool(INKSCAPE_WORKERS)
+
+
+def query_all(svg_filename, expected_ids=()):
+    """Return Inkscape's sizes of all elements, as CSV lines
+
+    The output is checked: each line needs an id and four numbers, and
+    all of ``expected_ids`` need to be there.
+    """
+    def check(output):
+        ids = set()
+        lines = output.decode('utf-8').splitlines()
+        for line in lines:
+            fields = line.rsplit(',', 4)
+            try:
+                if len(fields) != 5:
+                    raise ValueError()
+                [float(f) for f in fields[1:]]
+            except ValueError:
+                raise ValueError('bad query output line: {!r}'.format(line))
+            ids.add(fields[0])
+        if not lines:
+            raise ValueError('empty query output')
+        missing = set(expected_ids) - ids
+        if missing:
+            raise ValueError('query output is missing {}'.format(
+                ', '.join(sorted(missing))))
+    return pool.run([svg_filename, '--query-all'], check=check)
+
+
+def export_png(svg_filename, png_filename, *, id=None, width, height):
+    args = [svg_filename,
+            '--export-png', png_filename,
+            '--export-background-opacity', '0',
+            '--export-width', str(width),
+            '--export-height', str(height),
+            ]
+    if id is not None:
+        args.extend(['--export-area-snap',
+                     '--export-id', id])
+    else:
+        args.extend(['--export-area-page'])
+    pool.run(args)
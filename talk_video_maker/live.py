@@ -0,0 +1,399 @@
+"""Processing a talk while it's being recorded
+
+The input files are read as they grow. Audio features are computed as
+the data arrives, and the offset between the recordings is refined with
+each new window of audio (see LiveSync). Once the offset is known,
+stretches of the output are rendered as segments. Each segment is cached
+under the fingerprints of the inputs (see head_fingerprint) and its time
+range.
+When the recording ends, LiveSession.finish renders the rest and joins
+the segments without encoding them again.
+"""
+
+import os
+import subprocess
+import threading
+import time
+
+import numpy
+
+from . import analysis, dtw, objects, syncing, videos
+from .objects import hash_bytes, run
+
+POLL_INTERVAL = 1  # seconds
+TAIL_CHUNK_SIZE = 2**20
+
+# Features are computed in blocks of this many frames (about 6 s)
+LIVE_BLOCK_FRAMES = 256
+
+SEGMENT_LENGTH = 60  # seconds
+# Audio needed in all recordings before syncing starts
+MIN_SYNC_LENGTH = 120  # seconds
+# Input needed after the end of a segment before it's rendered
+SEGMENT_MARGIN = 10  # seconds
+
+MIN_SYNC_SIZE = MIN_SYNC_LENGTH * analysis.SAMPLE_RATE // analysis.HOP_LENGTH
+
+
+def tail(filename, is_finished, poll_interval=POLL_INTERVAL):
+    """Yield data as it's appended to a file
+
+    Stops at the end of the file, once is_finished() returns true.
+    """
+    with open(filename, 'rb') as f:
+        while True:
+            finished = is_finished()
+            data = f.read(TAIL_CHUNK_SIZE)
+            if data:
+                yield data
+            elif finished:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+def head_fingerprint(filename, is_finished, poll_interval=POLL_INTERVAL):
+    """Fingerprint the start of a file that's being written
+
+    Waits until the file has enough data (or is finished).
+    Recordings can start with the same data (e.g. headers and silence),
+    so the file's device and inode are included too.
+    """
+    size = objects.FINGERPRINT_CHUNK_SIZE
+    while True:
+        finished = is_finished()
+        try:
+            if os.path.getsize(filename) >= size or finished:
+                break
+        except FileNotFoundError:
+            if finished:
+                raise
+        time.sleep(poll_interval)
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        identity = '{} {}'.format(stat.st_dev, stat.st_ino)
+        return hash_bytes(b'head', identity.encode('utf-8'), f.read(size))
+
+
+class LiveFeatures:
+    """MFCC frames of a growing file, computed as the data arrives
+
+    ffmpeg decodes the audio from a pipe, which is fed by a thread that
+    tails the file. ``frames`` has all the frames computed so far.
+    """
+    def __init__(self, filename, is_finished):
+        self.process = objects.popen(
+            ['ffmpeg', '-i', 'pipe:0', '-vn',
+             '-ac', '1', '-ar', str(analysis.SAMPLE_RATE),
+             '-f', 's16le', '-c:a', 'pcm_s16le', 'pipe:1'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._blocks = []
+        self._lock = threading.Lock()
+        self.done = threading.Event()
+        self.error = None
+        self._feed_error = None
+        self._feeder = threading.Thread(
+            target=self._feed, args=(filename, is_finished), daemon=True)
+        self._feeder.start()
+        threading.Thread(target=self._analyse, daemon=True).start()
+
+    def _feed(self, filename, is_finished):
+        try:
+            for data in tail(filename, is_finished):
+                self.process.stdin.write(data)
+        except BrokenPipeError:
+            # ffmpeg exited; _analyse reports why
+            pass
+        except Exception as e:
+            # _analyse re-raises this once ffmpeg sees the end of input
+            self._feed_error = e
+        finally:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def _analyse(self):
+        try:
+            chunks = analysis.iter_frame_inputs(
+                analysis.iter_sample_blocks(
+                    self.process.stdout,
+                    LIVE_BLOCK_FRAMES * analysis.HOP_LENGTH),
+                block_frames=LIVE_BLOCK_FRAMES)
+            for chunk in chunks:
+                frames = analysis.mfcc_frames(chunk)
+                with self._lock:
+                    self._blocks.append(frames.astype(analysis.FEATURE_DTYPE))
+            self._feeder.join()
+            if self._feed_error is not None:
+                raise self._feed_error
+            returncode = self.process.wait()
+            if returncode:
+                raise subprocess.CalledProcessError(returncode,
+                                                    self.process.args)
+        except Exception as e:
+            self.error = e
+            # Don't leave the feeding thread blocked on a full pipe
+            self.process.kill()
+        finally:
+            self.done.set()
+
+    @property
+    def frames(self):
+        with self._lock:
+            if len(self._blocks) > 1:
+                self._blocks[:] = [numpy.concatenate(self._blocks)]
+            if self._blocks:
+                return self._blocks[0]
+        return numpy.zeros((0, analysis.N_MFCC), dtype=analysis.FEATURE_DTYPE)
+
+    def wait(self):
+        """Wait until all of the file is analysed"""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class LiveSync:
+    """Offset between two growing recordings, refined as audio arrives
+
+    This works like the 'anytime' sync method: once there's enough audio,
+    a cross-correlation offset is found and checked (see check_lag), and
+    windows of audio are matched with banded DTW around it as they become
+    available. Only windows with speech in both recordings are used.
+    If the offset isn't confirmed, it's looked for again when there's
+    MIN_SYNC_SIZE more frames of audio.
+    """
+    def __init__(self, features_a, features_b, max_stderr=1e-5,
+                 max_speed_error=1e-3,
+                 stable_windows=syncing.ANYTIME_STABLE_WINDOWS,
+                 window_size=syncing.ANYTIME_WINDOW_SIZE,
+                 band=syncing.DTW_PARALLEL_BAND_SIZE):
+        self.features_a = features_a
+        self.features_b = features_b
+        self.max_stderr = max_stderr
+        self.max_speed_error = max_speed_error
+        self.stable_windows = stable_windows
+        self.window_size = window_size
+        self.band = band
+        self.regression = syncing.IncrementalRegression()
+        self.lag = None
+        self.next_start = None
+        self.min_size = MIN_SYNC_SIZE
+        # Number of windows in a row after which the regression passed
+        self.stable = 0
+
+    def update(self):
+        """Match the audio that arrived since the last call
+
+        Returns the offset, or None if it's not known yet.
+        """
+        f1 = self.features_a.frames
+        f2 = self.features_b.frames
+        speech = analysis.speech_mask(f1), analysis.speech_mask(f2)
+        if self.lag is None:
+            if min(len(f1), len(f2)) < self.min_size:
+                return None
+            lag = syncing.xcorr_lag(f1[:, 0], f2[:, 0])
+            confirmed, path = syncing.check_lag(f1, f2, lag, speech=speech)
+            if not confirmed:
+                print('Live sync: offset of {} frames not confirmed; '
+                      'waiting for more audio'.format(lag))
+                self.min_size = min(len(f1), len(f2)) + MIN_SYNC_SIZE
+                return None
+            self.lag = lag
+            self.next_start = max(0, -self.lag)
+            print('Live sync: B is shifted by {} frames'.format(self.lag))
+        size = self.window_size
+        while self.next_start + size <= min(len(f1), len(f2) - self.lag):
+            start1 = self.next_start
+            start2 = start1 + self.lag
+            self.next_start += size
+            if not syncing.window_has_speech(speech, start1, start2, size):
+                continue
+            dist, path = dtw.dtw_banded(f1[start1:start1+size],
+                                        f2[start2:start2+size], self.band)
+            path = path.astype(int)
+            path = path[:, path.shape[1] // 4:path.shape[1] * 3 // 4]
+            self.regression.add(path[0] + start1, path[1] + start2)
+            slope, intercept, r, stderr = self.regression.stats
+            print('Live sync at {}: slope {}, offset {}, stderr {}'.format(
+                start1, slope, intercept, stderr))
+            if (stderr <= self.max_stderr and
+                    abs(slope - 1) <= self.max_speed_error):
+                self.stable += 1
+            else:
+                self.stable = 0
+        return self.offset
+
+    @property
+    def offset(self):
+        """Offset of A's audio relative to B's, in seconds, or None
+
+        The offset is None until the regression passes the same checks
+        as in get_audio_offset, after each of the last ``stable_windows``
+        windows (like the 'anytime' method's stopping rule).
+        """
+        if self.stable < self.stable_windows:
+            return None
+        slope, intercept, r, stderr = self.regression.stats
+        return intercept * analysis.HOP_LENGTH / analysis.SAMPLE_RATE
+
+
+class LiveInput:
+    """A video file that is still being recorded"""
+    def __init__(self, filename, is_finished):
+        self.filename = filename
+        self.fingerprint = head_fingerprint(filename, is_finished)
+        self.features = LiveFeatures(filename, is_finished)
+
+    @property
+    def duration(self):
+        """Length of the audio analysed so far, in seconds"""
+        return (len(self.features.frames) * analysis.HOP_LENGTH /
+                analysis.SAMPLE_RATE)
+
+    def segment(self, start, end):
+        """Return the part of the recording between two times (in seconds)
+
+        The movie is identified by the fingerprint of its start, so the
+        segment's hash stays the same as the file grows.
+        """
+        # ffprobe sees the file as it is now; don't reuse that later
+        size = os.path.getsize(self.filename)
+        info = videos.probe(self.filename, hash_bytes(
+            self.fingerprint.encode('utf-8'), str(size).encode('utf-8')))
+        video_info = next(s for s in info['streams']
+                          if s['codec_type'] == 'video')
+        stream_specs = ('dv', )
+        if any(s['codec_type'] == 'audio' for s in info['streams']):
+            stream_specs = ('dv', 'da')
+        streams = videos.filter_movie(
+            self.filename, stream_specs, duration=end - start,
+            fingerprint=self.fingerprint,
+            size=(int(video_info['width']), int(video_info['height'])),
+            seek_point=start).outputs
+        streams = videos.filter_streams(streams, {'video'}, 'fps',
+                                        {'fps': '25'})
+        streams = videos.filter_streams(
+            streams, {'video'}, 'format',
+            {'pix_fmts': 'rgba|yuva420p|yuva422p|yuva444p'})
+        # After seeking, timestamps are still those of the file
+        start_time = float(info['format'].get('start_time', 0))
+        opts = {'start': str(start_time + start), 'end': str(start_time + end)}
+        streams = videos.filter_streams(streams, {'video'}, 'trim', opts)
+        streams = videos.filter_streams(streams, {'audio'}, 'atrim', opts)
+        return videos.AVObject(videos.fix_pts(streams))
+
+
+class LiveSession:
+    """Render a talk while it's being recorded
+
+    ``filenames`` are the recordings; the first one is the reference for
+    syncing. ``compose`` gets a list of synchronized parts of the
+    recordings (AVObjects, in the order of ``filenames``), and returns
+    the AVObject to render for them.
+
+    Call ``poll`` every now and then while recording, and ``finish``
+    when the recording ended.
+    """
+    def __init__(self, filenames, compose, segment_length=SEGMENT_LENGTH,
+                 max_stderr=1e-5, max_speed_error=1e-3):
+        self.recording_ended = threading.Event()
+        self.inputs = [LiveInput(filename, self.recording_ended.is_set)
+                       for filename in filenames]
+        reference = self.inputs[0].features
+        self.syncs = [LiveSync(live_input.features, reference,
+                               max_stderr=max_stderr,
+                               max_speed_error=max_speed_error)
+                      for live_input in self.inputs[1:]]
+        self.compose = compose
+        self.segment_length = segment_length
+        # Time in each recording where the output starts; set once synced
+        self.cuts = None
+        self.segments = []
+
+    def poll(self):
+        """Update the sync, and render the segments that are ready
+
+        Returns the number of segments rendered.
+        """
+        if self.cuts is None and not self._update_sync():
+            return 0
+        rendered = 0
+        while True:
+            start = len(self.segments) * self.segment_length
+            end = start + self.segment_length
+            if any(live_input.duration < end + cut + SEGMENT_MARGIN
+                   for live_input, cut in zip(self.inputs, self.cuts)):
+                return rendered
+            self._render(start, end)
+            rendered += 1
+
+    def _update_sync(self):
+        offsets = [0] + [sync.update() for sync in self.syncs]
+        if any(offset is None for offset in offsets):
+            return False
+        print('Live sync: offsets {}'.format(offsets))
+        # Like offset_videos(..., mode='intersect')
+        shift = max(0, -min(offsets))
+        delays = [offset + shift for offset in offsets]
+        self.cuts = [max(delays) - delay for delay in delays]
+        return True
+
+    def _render(self, start, end):
+        parts = [live_input.segment(start + cut, end + cut)
+                 for live_input, cut in zip(self.inputs, self.cuts)]
+        segment = self.compose(parts)
+        print('Live segment {}-{} s: {}'.format(start, end, segment.filename))
+        self.segments.append(segment)
+
+    def finish(self, end_parts=()):
+        """Render the rest of the recording, and join all segments
+
+        ``end_parts`` (AVObjects, e.g. end slides) are added at the end;
+        they need the same size as the composed segments.
+        Returns an object whose ``filename`` is the whole video.
+        """
+        self.recording_ended.set()
+        for live_input in self.inputs:
+            live_input.features.wait()
+        if self.cuts is None and not self._update_sync():
+            raise ValueError('Audio sync: regression error too high')
+        self.poll()
+        start = len(self.segments) * self.segment_length
+        end = min(live_input.duration - cut
+                  for live_input, cut in zip(self.inputs, self.cuts))
+        if end > start:
+            self._render(start, end)
+        return objects.registry.intern(
+            JoinedVideo(self.segments + list(end_parts)))
+
+
+class JoinedVideo(objects.Object):
+    """Rendered videos joined with ffmpeg's concat demuxer, without encoding"""
+    ext = '.mkv'
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.hash = hash_bytes(
+            type(self).__name__.encode('utf-8'),
+            *(part.hash.encode('utf-8') for part in parts))
+
+    def save_to(self, filename):
+        list_filename = filename + '.txt'
+        try:
+            with open(list_filename, 'w') as f:
+                for part in self.parts:
+                    f.write("file '{}'\n".format(
+                        part.filename.replace("'", "'\\''")))
+            run(['ffmpeg', '-f', 'concat', '-safe', '0',
+                 '-i', list_filename,
+                 '-c', 'copy',
+                 '-f', videos.FORMAT_PARAMS['mkv'],
+                 filename])
+        finally:
+            try:
+                os.unlink(list_filename)
+            except FileNotFoundError:
+                pass
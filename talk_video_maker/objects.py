@@ -1,7 +1,43 @@
+import collections
 import hashlib
+import mmap
 import os
+import shutil
 import struct
 import subprocess
+import time
+
+
+CACHE_DIR = './__filecache__/'
+
+# Small artifacts that are read over and over (slide pictures, size queries,
+# SVG variants, sync paths, probe results) are also kept in a fast tier:
+# a directory on tmpfs, plus an in-process LRU of their contents.
+# The disk cache stays authoritative; the fast tier is write-through, so
+# a file in the fast tier is used without checking the disk cache.
+FAST_CACHE_EXTS = frozenset({'.png', '.sizes', '.svg', '.npy', '.probe'})
+FAST_CACHE_MAX_FILE_SIZE = 16 * 2**20
+FAST_CACHE_MEMORY = 64 * 2**20
+# Total size of the fast tier; least recently used files are removed
+FAST_CACHE_MAX_SIZE = int(os.environ.get('TALK_VIDEO_MAKER_FAST_CACHE_SIZE',
+                                         256 * 2**20))
+# Files used this recently (by any process) are not removed
+FAST_CACHE_GRACE_PERIOD = 60 * 60  # seconds
+
+# Budget (in approximate bytes) for parsed artifacts kept in memory
+PAYLOAD_CACHE_MEMORY = 256 * 2**20
+
+
+def _default_fast_cache_dir():
+    try:
+        return os.environ['TALK_VIDEO_MAKER_FAST_CACHE']
+    except KeyError:
+        pass
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm/talk_video_maker-{}/'.format(os.getuid())
+    return None
+
+FAST_CACHE_DIR = _default_fast_cache_dir()
 
 
 def hash_bytes(*args):
@@ -13,27 +49,281 @@ def hash_bytes(*args):
     return hasher.hexdigest()
 
 
+# Big files are fingerprinted by their size and a sample of their content:
+# chunks at the start, at the end, and at evenly spaced offsets in between.
+# Unlike names and mtimes, this survives copying and moving the files.
+FINGERPRINT_CHUNK_SIZE = 64 * 2**10
+FINGERPRINT_SAMPLES = 16
+STREAMING_HASH_BLOCK_SIZE = 2**20
+
+_fingerprints = {}
+
+
+def fingerprint_file(filename, *, sampled=True):
+    """Return a content fingerprint (hex string) of the given file
+
+    If ``sampled`` is true, only a sample of big files is read.
+    Results are remembered per inode and modification time.
+    """
+    stat = os.stat(filename)
+    key = stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size, sampled
+    try:
+        return _fingerprints[key]
+    except KeyError:
+        pass
+    sample_size = FINGERPRINT_CHUNK_SIZE * (FINGERPRINT_SAMPLES + 2)
+    if sampled and stat.st_size > sample_size:
+        result = _sampled_hash(filename, stat.st_size)
+    else:
+        result = _streaming_hash(filename)
+    _fingerprints[key] = result
+    return result
+
+
+def _streaming_hash(filename):
+    hasher = hashlib.sha256(b'full\0')
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(STREAMING_HASH_BLOCK_SIZE), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _sampled_hash(filename, size):
+    chunk = FINGERPRINT_CHUNK_SIZE
+    step = (size - chunk) // (FINGERPRINT_SAMPLES + 1)
+    offsets = [step * i for i in range(FINGERPRINT_SAMPLES + 1)]
+    offsets.append(size - chunk)
+    hasher = hashlib.sha256(b'sampled\0')
+    hasher.update(struct.pack('!Q', size))
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for offset in offsets:
+                hasher.update(mapped[offset:offset + chunk])
+    return hasher.hexdigest()
+
+
+_fast_cache_subdirs = {}
+
+
+def _fast_cache_subdir():
+    """Directory of the fast tier for the current CACHE_DIR
+
+    Each cache directory gets its own part of the fast tier, so projects
+    don't share (possibly stale) files. The directory's inode is part of
+    the key, so a removed and recreated cache doesn't get old files.
+    """
+    cache_dir = os.path.abspath(CACHE_DIR)
+    try:
+        return _fast_cache_subdirs[cache_dir]
+    except KeyError:
+        pass
+    os.makedirs(cache_dir, exist_ok=True)
+    stat = os.stat(cache_dir)
+    key = '{}\0{}\0{}'.format(cache_dir, stat.st_dev, stat.st_ino)
+    subdir = os.path.join(
+        FAST_CACHE_DIR, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+    _fast_cache_subdirs[cache_dir] = subdir
+    return subdir
+
+
+class FastCacheSpace:
+    """Keeps the fast tier under FAST_CACHE_MAX_SIZE
+
+    The size of the tier is found by listing it once per process,
+    then kept up to date as files are added.
+    Files used by this process are not evicted, nor are files used in the
+    last FAST_CACHE_GRACE_PERIOD (other processes might be using them).
+    """
+    def __init__(self):
+        self.size = None
+        self.in_use = set()
+
+    def _scan(self, directory):
+        files = []
+        for entry in os.scandir(directory):
+            if entry.is_file() and not entry.name.endswith('~'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.path, stat.st_size))
+        return files
+
+    def reserve(self, directory, size):
+        """Make room for a new file of the given size
+
+        Returns false if there's no room.
+        """
+        if self.size is None:
+            self.size = sum(s for t, p, s in self._scan(directory))
+        if self.size + size <= FAST_CACHE_MAX_SIZE:
+            self.size += size
+            return True
+        # Evict the least recently used files (by mtime; see Object.save)
+        files = sorted(self._scan(directory))
+        self.size = sum(s for t, p, s in files)
+        recent = time.time() - FAST_CACHE_GRACE_PERIOD
+        for mtime, path, file_size in files:
+            if self.size + size <= FAST_CACHE_MAX_SIZE or mtime > recent:
+                break
+            if path in self.in_use:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.size -= file_size
+        if self.size + size > FAST_CACHE_MAX_SIZE:
+            return False
+        self.size += size
+        return True
+
+
+fast_cache_space = FastCacheSpace()
+
+
 def run(argv):
     print('Running', argv)
     return subprocess.check_output(argv)
 
 
+def popen(argv, **kwargs):
+    print('Running', argv)
+    return subprocess.Popen(argv, **kwargs)
+
+
+class LRUCache:
+    """Mapping that forgets least recently used items over a size budget
+
+    The size of each item is given by ``sizeof``.
+    Items bigger than the whole budget are not stored at all.
+    """
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._items = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __getitem__(self, key):
+        value, size = self._items[key]
+        self._items.move_to_end(key)
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.put(key, value, self.sizeof(value))
+
+    def put(self, key, value, size):
+        self.pop(key, None)
+        if size > self.max_size:
+            return
+        self._items[key] = value, size
+        self.size += size
+        while self.size > self.max_size:
+            _key, (_value, old_size) = self._items.popitem(last=False)
+            self.size -= old_size
+
+    def pop(self, key, *default):
+        try:
+            value, size = self._items.pop(key)
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        self.size -= size
+        return value
+
+
+fast_cache_contents = LRUCache(FAST_CACHE_MEMORY)
+
+
+class Registry:
+    """Process-wide identity map of cacheable objects
+
+    ``intern`` returns one instance per type and hash, so whatever an object
+    remembers (e.g. its filename) is shared by all equivalent objects.
+
+    ``payload`` keeps parsed contents of artifacts (DOMs, size tables,
+    probe results, sync statistics) in memory. These can be big, so they
+    are evicted in LRU order when over budget, and recomputed if needed.
+    """
+    def __init__(self, max_payload_size):
+        self._objects = {}
+        self.payloads = LRUCache(max_payload_size)
+
+    def intern(self, obj):
+        return self._objects.setdefault((type(obj), obj.hash), obj)
+
+    def payload(self, key, compute, size=1):
+        """Get a payload, computing it if needed
+
+        ``size`` is the approximate size in bytes, or a function that
+        computes it from the payload.
+        """
+        try:
+            return self.payloads[key]
+        except KeyError:
+            pass
+        value = compute()
+        if callable(size):
+            size = size(value)
+        self.payloads.put(key, value, size)
+        return value
+
+
+registry = Registry(PAYLOAD_CACHE_MEMORY)
+
+
+def _makedirs_for(filename):
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except FileExistsError:
+        pass
+
+
 class Object:
     is_big_file = False
 
     def get_filename(self, *, ext=None):
         if ext is None:
             ext = self.ext
-        return os.path.abspath(os.path.join('./__filecache__/', self.hash + ext))
+        return os.path.abspath(os.path.join(CACHE_DIR, self.hash + ext))
+
+    def get_fast_filename(self):
+        """Return the filename in the fast tier, or None if not applicable"""
+        if (FAST_CACHE_DIR is None or self.is_big_file or
+                self.ext not in FAST_CACHE_EXTS):
+            return None
+        return os.path.abspath(os.path.join(_fast_cache_subdir(),
+                                            self.hash + self.ext))
 
     def save(self):
+        fast_filename = self.get_fast_filename()
+        if fast_filename:
+            try:
+                # Mark as recently used, for eviction
+                os.utime(fast_filename)
+            except OSError:
+                pass
+            else:
+                fast_cache_space.in_use.add(fast_filename)
+                self._filename = fast_filename
+                return fast_filename
         filename = self.get_filename()
-        if os.path.exists(filename):
-            return filename
-        try:
-            os.makedirs(os.path.dirname(filename))
-        except FileExistsError:
-            pass
+        if not os.path.exists(filename):
+            self._save_to_disk(filename)
+        if fast_filename:
+            filename = self._promote(filename, fast_filename)
+        self._filename = filename
+        return filename
+
+    def _save_to_disk(self, filename):
+        _makedirs_for(filename)
         if os.path.exists(filename + '~'):
             os.unlink(filename + '~')
         try:
@@ -48,8 +338,36 @@ class Object:
             os.rename(filename + '~', filename)
         if not os.path.exists(filename):
             raise RuntimeError('file not saved to {}'.format(filename))
-        self._filename = filename
-        return filename
+
+    def _promote(self, filename, fast_filename):
+        """Copy a small artifact to the fast tier; return the name to use"""
+        size = os.path.getsize(filename)
+        if size > FAST_CACHE_MAX_FILE_SIZE:
+            return filename
+        try:
+            _makedirs_for(fast_filename)
+            if not fast_cache_space.reserve(os.path.dirname(fast_filename),
+                                            size):
+                return filename
+            shutil.copyfile(filename, fast_filename + '~')
+            os.rename(fast_filename + '~', fast_filename)
+        except OSError:
+            return filename
+        fast_cache_space.in_use.add(fast_filename)
+        return fast_filename
+
+    def read_bytes(self):
+        """Return the saved contents, from memory if possible"""
+        key = self.hash + self.ext
+        try:
+            return fast_cache_contents[key]
+        except KeyError:
+            pass
+        with open(self.filename, 'rb') as f:
+            data = f.read()
+        if not self.is_big_file and self.ext in FAST_CACHE_EXTS:
+            fast_cache_contents[key] = data
+        return data
 
     @property
     def filename(self):
@@ -67,17 +385,16 @@ class Object:
 class InputObject(Object):
     def __init__(self, *, filename=None):
         self.filename = filename
-        stat = os.stat(filename)
-        self.file_size = stat.st_size
-        if self.is_big_file:
-            packed = struct.pack('!LL', self.file_size, int(stat.st_mtime))
-            self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
-                                   bytes(filename, 'utf-8'), packed)
-        else:
-            with open(filename, 'rb') as f:
-                self.bytes = f.read()
-                self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
-                                       self.bytes)
+        self.file_size = os.stat(filename).st_size
+        self.fingerprint = fingerprint_file(filename,
+                                            sampled=self.is_big_file)
+        self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
+                               self.fingerprint.encode('utf-8'))
+
+    @property
+    def bytes(self):
+        with open(self.filename, 'rb') as f:
+            return f.read()
 
     def __repr__(self):
         return '<{} from {!r}>'.format(type(self).__name__, self.filename)
@@ -6,7 +6,7 @@ import os
 import yaml
 
 from .templates import InputTemplate
-from .videos import InputVideo
+from .videos import InputVideo, probe_many
 
 class Nothing:
     def __bool__(self):
@@ -14,7 +14,7 @@ class Nothing:
 
 NOTHING = Nothing()
 
-def fileglob(pattern, default, base='.'):
+def fileglob(pattern, default, base='.', warn=True):
     if pattern is None:
         pattern = default
     result = []
@@ -24,7 +24,7 @@ def fileglob(pattern, default, base='.'):
                 result.append(os.path.abspath(subitem))
         else:
             result.append(item)
-    if not result:
+    if not result and warn:
         print('Base:', base)
         print('Pattern:', pattern)
         print('Default:', default)
@@ -49,6 +49,10 @@ class Option:
         if params['help'] and self.default is not NOTHING and self.default:
             params['help'] += ' [default: {}]'.format(self.default)
 
+    def input_filenames(self, value, all_opts):
+        """Return media files that coercing the value will need to probe"""
+        return []
+
 
 class TemplateOption(Option):
     def set_arg_params(self, params):
@@ -77,6 +81,13 @@ class VideoOption(Option):
         params.setdefault('metavar', 'FILE')
         super().set_arg_params(params)
 
+    def input_filenames(self, value, all_opts):
+        conf_path = all_opts.get('config') or './config.yaml'
+        base = os.path.dirname(conf_path)
+        if isinstance(value, str):
+            return fileglob(value, self.default, base, warn=False)
+        return []
+
     def coerce(self, value, all_opts):
         conf_path = all_opts.get('config') or './config.yaml'
         base = os.path.dirname(conf_path)
@@ -200,6 +211,11 @@ def parse_options(signature, argv):
 
 
 def coerce_options(signature, options_in):
+    # Probe all input media up front, in parallel
+    probe_many([filename
+                for param in signature.parameters.values()
+                for filename in param.annotation.input_filenames(
+                    options_in[param.name], options_in)])
     options_out = {}
     for param in signature.parameters.values():
         value = param.annotation.coerce(options_in[param.name], options_in)
@@ -0,0 +1,140 @@
+"""Minimal PNG encoding and decoding with NumPy
+
+Only what we need: 8-bit images, no interlacing.
+"""
+
+import struct
+import zlib
+
+import numpy
+
+SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# PNG color type -> number of channels
+CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+COLOR_TYPES = {1: 0, 2: 4, 3: 2, 4: 6}
+
+
+def _chunk(kind, data):
+    return b''.join([
+        struct.pack('!I', len(data)),
+        kind,
+        data,
+        struct.pack('!I', zlib.crc32(kind + data) & 0xffffffff),
+    ])
+
+
+def encode_png(pixels, compression=6):
+    """Encode an array of shape (height, width[, channels]) to PNG bytes"""
+    pixels = numpy.asarray(pixels, dtype=numpy.uint8)
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    height, width, channels = pixels.shape
+    header = struct.pack('!IIBBBBB', width, height, 8,
+                         COLOR_TYPES[channels], 0, 0, 0)
+    # Each row is prefixed by its filter type (0: none)
+    raw = numpy.zeros((height, width * channels + 1), dtype=numpy.uint8)
+    raw[:, 1:] = pixels.reshape(height, width * channels)
+    return b''.join([
+        SIGNATURE,
+        _chunk(b'IHDR', header),
+        _chunk(b'IDAT', zlib.compress(raw.tobytes(), compression)),
+        _chunk(b'IEND', b''),
+    ])
+
+
+def decode_png(data):
+    """Decode PNG bytes to an RGBA array of shape (height, width, 4)"""
+    if data[:8] != SIGNATURE:
+        raise ValueError('not a PNG file')
+    pos = 8
+    idat = []
+    palette = None
+    transparency = None
+    while pos < len(data):
+        length, kind = struct.unpack('!I4s', data[pos:pos+8])
+        body = data[pos+8:pos+8+length]
+        pos += length + 12
+        if kind == b'IHDR':
+            (width, height, depth, color_type,
+             _compression, _filter, interlace) = struct.unpack('!IIBBBBB', body)
+        elif kind == b'PLTE':
+            palette = numpy.frombuffer(body, dtype=numpy.uint8).reshape(-1, 3)
+        elif kind == b'tRNS':
+            transparency = numpy.frombuffer(body, dtype=numpy.uint8)
+        elif kind == b'IDAT':
+            idat.append(body)
+        elif kind == b'IEND':
+            break
+    if depth != 8 or interlace:
+        raise ValueError('unsupported PNG (bit depth {}, interlace {})'.format(
+            depth, interlace))
+    channels = CHANNELS[color_type]
+    raw = zlib.decompress(b''.join(idat))
+    pixels = _unfilter(raw, width, height, channels)
+    pixels = pixels.reshape(height, width, channels)
+
+    if color_type == 3:
+        alpha = numpy.full(len(palette), 255, dtype=numpy.uint8)
+        if transparency is not None:
+            alpha[:len(transparency)] = transparency
+        indices = pixels[:, :, 0]
+        return numpy.dstack([palette[indices], alpha[indices]])
+    if channels < 3:
+        gray = numpy.repeat(pixels[:, :, :1], 3, axis=2)
+        pixels = numpy.dstack([gray, pixels[:, :, 1:]])
+    if pixels.shape[2] == 3:
+        alpha = numpy.full(pixels.shape[:2], 255, dtype=numpy.uint8)
+        pixels = numpy.dstack([pixels, alpha])
+    return pixels
+
+
+def _unfilter(raw, width, height, bpp):
+    stride = width * bpp
+    result = numpy.zeros((height, stride), dtype=numpy.uint8)
+    prev = numpy.zeros(stride, dtype=numpy.int32)
+    for y in range(height):
+        start = y * (stride + 1)
+        filter_type = raw[start]
+        line = numpy.frombuffer(raw, dtype=numpy.uint8,
+                                count=stride, offset=start + 1)
+        line = line.astype(numpy.int32)
+        if filter_type == 0:
+            row = line
+        elif filter_type == 1:
+            row = numpy.cumsum(line.reshape(width, bpp), axis=0).ravel() % 256
+        elif filter_type == 2:
+            row = (line + prev) % 256
+        elif filter_type in (3, 4):
+            row = _unfilter_sequential(filter_type, line.tolist(),
+                                       prev.tolist(), bpp)
+            row = numpy.array(row, dtype=numpy.int32)
+        else:
+            raise ValueError('bad PNG filter type {}'.format(filter_type))
+        result[y] = row
+        prev = row
+    return result
+
+
+def _unfilter_sequential(filter_type, line, prev, bpp):
+    # "Average" and "Paeth" filters depend on the decoded byte to the left
+    row = [0] * len(line)
+    for i, value in enumerate(line):
+        left = row[i - bpp] if i >= bpp else 0
+        up = prev[i]
+        if filter_type == 3:
+            row[i] = (value + (left + up) // 2) % 256
+        else:
+            up_left = prev[i - bpp] if i >= bpp else 0
+            p = left + up - up_left
+            pa = abs(p - left)
+            pb = abs(p - up)
+            pc = abs(p - up_left)
+            if pa <= pb and pa <= pc:
+                predictor = left
+            elif pb <= pc:
+                predictor = up
+            else:
+                predictor = up_left
+            row[i] = (value + predictor) % 256
+    return row
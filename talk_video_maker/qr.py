@@ -1,25 +1,85 @@
 import io
 import lxml.etree
 
+import numpy
 import qrcode
 from qrcode.image.svg import SvgPathImage
 
-from . import templates
+from . import objects, png, templates
 from .objects import hash_bytes, run
 
 class TextQR(templates.Template):
-    def __init__(self, text):
+    """QR code for a text
+
+    Exported pictures are drawn straight from the module matrix,
+    without Inkscape.
+    """
+    def __init__(self, text, size=None):
         self.text = text
-        self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
-                               text.encode('utf-8'))
+        self.size = size
+        parts = [type(self).__name__.encode('utf-8'), text.encode('utf-8')]
+        if size is not None:
+            parts.extend(str(s).encode('utf-8') for s in size)
+        self.hash = hash_bytes(*parts)
 
     @property
-    def dom(self):
+    def qr(self):
+        text_hash = hash_bytes(b'qr', self.text.encode('utf-8'))
+        return objects.registry.payload(
+            (text_hash, 'qr'), self._make_qr,
+            size=lambda qr: 100 * len(qr.get_matrix()) ** 2)
+
+    def _make_qr(self):
         qr = qrcode.QRCode(box_size=10,
                            image_factory=SvgPathImage)
         qr.add_data(self.text)
         qr.print_ascii()
-        img = qr.make_image()
+        return qr
+
+    def resized(self, width, height):
+        return TextQR(self.text, (width, height))
+
+    def get_dom(self):
+        img = self.qr.make_image()
         with io.BytesIO() as f:
             img.save(f)
-            return lxml.etree.XML(f.getvalue())
+            dom = lxml.etree.XML(f.getvalue())
+        if self.size is not None:
+            dom.attrib['width'], dom.attrib['height'] = (
+                str(s) for s in self.size)
+        return dom
+
+    def exported_picture(self, id=None, width=None, height=None):
+        if id is not None:
+            return super().exported_picture(id, width, height)
+        if width is None:
+            width = self.width
+        if height is None:
+            height = self.height
+        def write_image(filename):
+            with open(filename, 'wb') as f:
+                f.write(png.encode_png(self.pixels(width, height)))
+        image = templates.GeneratedImage(
+            # 'meet': non-square pictures are centered, like the SVG's
+            hash_bytes(b'qr-picture', b'meet', self.text.encode('utf-8'),
+                       str(width).encode('utf-8'),
+                       str(height).encode('utf-8')).encode('utf-8'),
+            write_image, size=(width, height), batch_key='qr')
+        return objects.registry.intern(image).deferred()
+
+    def pixels(self, width, height):
+        """Render the code as gray+alpha pixels, scaling modules to fit
+
+        Dark modules are opaque black; the rest is transparent.
+        Like the SVG (with its default preserveAspectRatio), the code is
+        a square as big as fits, centered.
+        """
+        matrix = numpy.array(self.qr.get_matrix(), dtype=bool)
+        side = min(width, height)
+        indices = numpy.arange(side) * len(matrix) // side
+        dark = matrix[indices][:, indices]
+        top = (height - side) // 2
+        left = (width - side) // 2
+        result = numpy.zeros((height, width, 2), dtype=numpy.uint8)
+        result[top:top+side, left:left+side, 1] = dark * 255
+        return result
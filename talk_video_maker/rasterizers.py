@@ -0,0 +1,183 @@
+"""Backends that turn templates into PNG pictures
+
+Inkscape is the reference implementation. It renders everything, but
+it is slow to start and runs out of process.
+The Cairo backend (using the optional ``cairosvg`` package) renders
+straight from the DOM, in process, but it doesn't know about Inkscape
+extensions like flowed text. Each export is routed to the first backend
+that supports everything that can show up in the exported area.
+
+Use ``check_routing`` to compare the routed backend's output with
+Inkscape's pixel by pixel.
+"""
+
+import math
+import os
+import tempfile
+
+import lxml.etree
+import numpy
+
+from . import inkscape, png, svg
+
+try:
+    import cairosvg
+except (ImportError, OSError):
+    # OSError: the Cairo library itself is missing
+    cairosvg = None
+
+
+class Rasterizer:
+    name = None
+
+    def is_available(self):
+        return True
+
+    def supports(self, template, id):
+        raise NotImplementedError()
+
+    def render(self, template, filename, *, id, width, height):
+        raise NotImplementedError()
+
+
+class InkscapeRasterizer(Rasterizer):
+    name = 'inkscape'
+
+    def supports(self, template, id):
+        return True
+
+    def render(self, template, filename, *, id, width, height):
+        inkscape.export_png(template.filename, filename, id=id,
+                            width=width, height=height)
+
+
+class CairoRasterizer(Rasterizer):
+    name = 'cairo'
+
+    # Plain <text> is supported, though fonts might be picked differently
+    # than in Inkscape; check_routing shows whether the output matches
+    unsupported_tags = frozenset({
+        'flowRoot', 'foreignObject', 'switch', 'filter'})
+
+    def is_available(self):
+        return cairosvg is not None
+
+    def supports(self, template, id):
+        # Inkscape exports everything visible in the element's area,
+        # so all elements that can show up there are checked
+        for drawn in template.drawn_elements(id):
+            for elem in [*drawn.iter(), *drawn.iterancestors()]:
+                name = svg.local_name(elem)
+                if name is None:
+                    continue
+                if name in self.unsupported_tags:
+                    return False
+                if 'filter' in elem.attrib or 'filter' in svg.parse_style(elem):
+                    return False
+        return True
+
+    def render(self, template, filename, *, id, width, height):
+        dom = template._dom_copy()
+        if id is None:
+            box = svg.viewbox(dom)
+            if box is None:
+                box = 0, 0, template.width, template.height
+        else:
+            box = _export_area(dom, template.element_sizes[id])
+        dom.attrib['viewBox'] = ' '.join(str(v) for v in box)
+        dom.attrib['width'] = str(width)
+        dom.attrib['height'] = str(height)
+        dom.attrib['preserveAspectRatio'] = 'none'
+        cairosvg.svg2png(bytestring=lxml.etree.tostring(dom),
+                         write_to=filename,
+                         output_width=width, output_height=height)
+
+
+def _export_area(dom, sizes):
+    """Return the viewBox Inkscape exports for an element
+
+    Query sizes are in document pixels from the page's corner; like
+    Inkscape's --export-area-snap, the area is rounded outwards to whole
+    pixels.
+    """
+    scale = svg.user_unit_scale(dom)
+    origin_x, origin_y = (svg.viewbox(dom) or (0, 0))[:2]
+    left = math.floor(sizes['x'])
+    top = math.floor(sizes['y'])
+    right = math.ceil(sizes['x'] + sizes['w'])
+    bottom = math.ceil(sizes['y'] + sizes['h'])
+    return (origin_x + left / scale, origin_y + top / scale,
+            (right - left) / scale, (bottom - top) / scale)
+
+
+INKSCAPE = InkscapeRasterizer()
+CAIRO = CairoRasterizer()
+
+# Fastest first
+RASTERIZERS = [CAIRO, INKSCAPE]
+
+
+def get_rasterizer(name):
+    for rasterizer in RASTERIZERS:
+        if rasterizer.name == name:
+            return rasterizer
+    raise LookupError('unknown rasterizer {!r}'.format(name))
+
+
+def choose_rasterizer(template, id=None):
+    """Return the fastest available rasterizer that can export the element
+
+    The TALK_VIDEO_MAKER_RASTERIZER environment variable can force
+    a particular backend.
+    """
+    forced = os.environ.get('TALK_VIDEO_MAKER_RASTERIZER')
+    if forced:
+        return get_rasterizer(forced)
+    for rasterizer in RASTERIZERS:
+        if rasterizer.is_available() and rasterizer.supports(template, id):
+            return rasterizer
+    return INKSCAPE
+
+
+def compare_rasterizers(template, id=None, width=None, height=None, *,
+                        candidate, reference=INKSCAPE):
+    """Render with two backends and return pixel differences
+
+    Returns the maximum and mean absolute difference of alpha-premultiplied
+    RGBA values (on a 0-255 scale).
+    """
+    if width is None:
+        width = template.element_sizes[id]['w']
+    if height is None:
+        height = template.element_sizes[id]['h']
+    pictures = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for rasterizer in reference, candidate:
+            filename = os.path.join(tmpdir, rasterizer.name + '.png')
+            rasterizer.render(template, filename, id=id,
+                              width=width, height=height)
+            with open(filename, 'rb') as f:
+                pixels = png.decode_png(f.read()).astype(numpy.float64)
+            alpha = pixels[:, :, 3:] / 255
+            pixels[:, :, :3] *= alpha
+            pictures.append(pixels)
+    diff = numpy.abs(pictures[0] - pictures[1])
+    return {'max': float(diff.max()), 'mean': float(diff.mean())}
+
+
+def check_routing(template, ids, *, max_mean_diff=2):
+    """Check that elements are routed to backends that match Inkscape
+
+    Returns a dict of {id: (rasterizer name, differences)} for elements
+    whose routed rasterizer differs too much from Inkscape.
+    """
+    failures = {}
+    for id in ids:
+        rasterizer = choose_rasterizer(template, id)
+        if rasterizer is INKSCAPE:
+            continue
+        diff = compare_rasterizers(template, id, candidate=rasterizer)
+        print('{}: {} vs. inkscape: {}'.format(id, rasterizer.name, diff))
+        if diff['mean'] > max_mean_diff:
+            failures[id] = rasterizer.name, diff
+    return failures
@@ -0,0 +1,379 @@
+"""Helpers for working with SVG DOMs"""
+
+import math
+import re
+
+from .objects import fingerprint_file
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+
+def local_name(elem):
+    tag = elem.tag
+    if not isinstance(tag, str):
+        # comments, processing instructions
+        return None
+    return tag.rpartition('}')[2]
+
+
+def parse_style(elem):
+    result = {}
+    for item in elem.attrib.get('style', '').split(';'):
+        name, sep, value = item.partition(':')
+        if sep:
+            result[name.strip()] = value.strip()
+    return result
+
+
+def is_hidden(elem):
+    """True if the element itself is made invisible
+
+    (Ancestors are not checked.)
+    """
+    style = parse_style(elem)
+    if style.get('display', elem.attrib.get('display')) == 'none':
+        return True
+    opacity = style.get('opacity', elem.attrib.get('opacity', '1'))
+    try:
+        return float(opacity) == 0
+    except ValueError:
+        return False
+
+
+def iter_visible(elem):
+    """Iterate over the element and its descendants that are not hidden"""
+    if local_name(elem) is None or is_hidden(elem):
+        return
+    yield elem
+    for child in elem:
+        yield from iter_visible(child)
+
+
+def viewbox(dom):
+    """Return the root's viewBox as (x, y, w, h), or None if not valid"""
+    try:
+        values = [float(v) for v in
+                  dom.attrib['viewBox'].replace(',', ' ').split()]
+    except (KeyError, ValueError):
+        return None
+    if len(values) != 4 or values[2] <= 0 or values[3] <= 0:
+        return None
+    return tuple(values)
+
+
+def user_unit_scale(dom):
+    """Return the size of one user unit, in document pixels"""
+    box = viewbox(dom)
+    if box is None:
+        return 1
+    return float(dom.attrib['width']) / box[2]
+
+
+def find_by_id(dom, id):
+    for elem in dom.iter('*'):
+        if elem.get('id') == id:
+            return elem
+    return None
+
+
+class ElementIndex:
+    """Index of a DOM's elements by ID
+
+    Code that changes IDs in the DOM must update the index.
+    """
+    def __init__(self, dom):
+        self._elements = {}
+        for elem in dom.iter('*'):
+            id = elem.get('id')
+            if id is not None:
+                self._elements.setdefault(id, []).append(elem)
+
+    def __len__(self):
+        return len(self._elements)
+
+    def find(self, id):
+        return list(self._elements.get(id, ()))
+
+    def add(self, id, elem):
+        self._elements.setdefault(id, []).append(elem)
+
+    def remove(self, id, elem):
+        elems = self._elements.get(id, [])
+        if elem in elems:
+            elems.remove(elem)
+
+
+def are_related(index, id_a, id_b):
+    """True if the two elements are the same, or one contains the other
+
+    Elements are looked up in the given ElementIndex.
+    """
+    elems_a = index.find(id_a)
+    elems_b = index.find(id_b)
+    if not elems_a or not elems_b:
+        return True
+    elem_a = elems_a[0]
+    elem_b = elems_b[0]
+    if elem_a is elem_b:
+        return True
+    return (elem_a in elem_b.iterancestors() or
+            elem_b in elem_a.iterancestors())
+
+
+# Affine transforms are tuples (a, b, c, d, e, f), as in SVG's matrix()
+
+IDENTITY = 1, 0, 0, 1, 0, 0
+
+
+def multiply(m1, m2):
+    """Return the transform that applies m2, then m1"""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1 * a2 + c1 * b2,
+        b1 * a2 + d1 * b2,
+        a1 * c2 + c1 * d2,
+        b1 * c2 + d1 * d2,
+        a1 * e2 + c1 * f2 + e1,
+        b1 * e2 + d1 * f2 + f1,
+    )
+
+
+def apply(matrix, x, y):
+    a, b, c, d, e, f = matrix
+    return a * x + c * y + e, b * x + d * y + f
+
+
+_TRANSFORM_RE = re.compile(r'\s*(\w+)\s*\(([^)]*)\)\s*,?')
+
+
+def parse_transform(text):
+    """Parse a transform attribute; return None if it can't be parsed"""
+    matrix = IDENTITY
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TRANSFORM_RE.match(text, pos)
+        if not match:
+            return None
+        pos = match.end()
+        name = match.group(1)
+        try:
+            args = [float(a) for a in
+                    match.group(2).replace(',', ' ').split()]
+        except ValueError:
+            return None
+        if name == 'matrix' and len(args) == 6:
+            step = tuple(args)
+        elif name == 'translate' and len(args) in (1, 2):
+            step = 1, 0, 0, 1, args[0], args[1] if len(args) == 2 else 0
+        elif name == 'scale' and len(args) in (1, 2):
+            sx = args[0]
+            sy = args[1] if len(args) == 2 else sx
+            step = sx, 0, 0, sy, 0, 0
+        elif name == 'rotate' and len(args) in (1, 3):
+            angle = math.radians(args[0])
+            cos, sin = math.cos(angle), math.sin(angle)
+            step = cos, sin, -sin, cos, 0, 0
+            if len(args) == 3:
+                cx, cy = args[1:]
+                step = multiply((1, 0, 0, 1, cx, cy),
+                                multiply(step, (1, 0, 0, 1, -cx, -cy)))
+        elif name == 'skewX' and len(args) == 1:
+            step = 1, 0, math.tan(math.radians(args[0])), 1, 0, 0
+        elif name == 'skewY' and len(args) == 1:
+            step = 1, math.tan(math.radians(args[0])), 0, 1, 0, 0
+        else:
+            return None
+        matrix = multiply(matrix, step)
+    return matrix
+
+
+def _effective_property(elem, name, default):
+    for node in [elem] + list(elem.iterancestors()):
+        style = parse_style(node)
+        if name in style:
+            return style[name]
+        if name in node.attrib:
+            return node.attrib[name]
+    return default
+
+
+def plain_bbox(dom, id):
+    """Compute the bounding box of a simple element, in document pixels
+
+    Only unstroked rectangles and images are handled: for these, the
+    visual bounding box Inkscape reports is just the (transformed)
+    geometry. Returns a dict with 'x', 'y', 'w', 'h', or None if the
+    element isn't simple enough.
+    """
+    elem = find_by_id(dom, id)
+    if elem is None:
+        return None
+    return element_bbox(dom, elem)
+
+
+def element_bbox(dom, elem):
+    """Like plain_bbox, but takes the element itself"""
+    if local_name(elem) not in ('rect', 'image'):
+        return None
+    if _effective_property(elem, 'stroke', 'none') != 'none':
+        return None
+    try:
+        x = float(elem.attrib.get('x', 0))
+        y = float(elem.attrib.get('y', 0))
+        w = float(elem.attrib['width'])
+        h = float(elem.attrib['height'])
+    except (KeyError, ValueError):
+        # missing attributes, or values with units
+        return None
+    matrix = IDENTITY
+    for node in [elem] + list(elem.iterancestors()):
+        if 'transform' in node.attrib:
+            transform = parse_transform(node.attrib['transform'])
+            if transform is None:
+                return None
+            matrix = multiply(transform, matrix)
+    scale = user_unit_scale(dom)
+    box = viewbox(dom) or (0, 0, None, None)
+    matrix = multiply((scale, 0, 0, scale, -box[0] * scale, -box[1] * scale),
+                      matrix)
+    corners = [apply(matrix, cx, cy)
+               for cx in (x, x + w) for cy in (y, y + h)]
+    xs = [c[0] for c in corners]
+    ys = [c[1] for c in corners]
+    # Inkscape doesn't report more precision than this
+    return {
+        'x': round(min(xs), 4),
+        'y': round(min(ys), 4),
+        'w': round(max(xs) - min(xs), 4),
+        'h': round(max(ys) - min(ys), 4),
+    }
+
+
+def flowed_text_bbox(dom, elem):
+    """Bounding box of the region a flowRoot's text is flowed into
+
+    Inkscape doesn't render text that doesn't fit the region, so the
+    text stays within this box whatever it says.
+    Returns None if the region isn't made of simple shapes.
+    """
+    shapes = [shape
+              for region in elem.findall('./{*}flowRegion')
+              for shape in region]
+    boxes = [element_bbox(dom, shape) for shape in shapes]
+    if not boxes or None in boxes:
+        return None
+    return union(boxes)
+
+
+def union(boxes):
+    x = min(b['x'] for b in boxes)
+    y = min(b['y'] for b in boxes)
+    return {
+        'x': x,
+        'y': y,
+        'w': max(b['x'] + b['w'] for b in boxes) - x,
+        'h': max(b['y'] + b['h'] for b in boxes) - y,
+    }
+
+
+def intersects(box_a, box_b, margin=1):
+    return (box_a['x'] < box_b['x'] + box_b['w'] + margin and
+            box_b['x'] < box_a['x'] + box_a['w'] + margin and
+            box_a['y'] < box_b['y'] + box_b['h'] + margin and
+            box_b['y'] < box_a['y'] + box_a['h'] + margin)
+
+
+# Elements that draw something (and whose children are part of them)
+GRAPHIC_TAGS = frozenset({
+    'rect', 'circle', 'ellipse', 'line', 'polyline', 'polygon', 'path',
+    'image', 'use', 'text', 'flowRoot'})
+
+# Elements that group others
+CONTAINER_TAGS = frozenset({'svg', 'g', 'a', 'switch'})
+
+# Attributes that don't affect rendering
+IGNORED_ATTRS = frozenset({
+    'id',
+    '{http://www.inkscape.org/namespaces/inkscape}label',
+    '{http://www.inkscape.org/namespaces/inkscape}groupmode',
+    '{http://www.inkscape.org/namespaces/inkscape}connector-curvature',
+})
+
+_URL_RE = re.compile(r'url\(\s*#([^)\s]+)\s*\)')
+_HREFS = 'href', '{%s}href' % XLINK_NS
+
+
+def iter_drawn(elem):
+    """Iterate over visible graphic elements under elem, in document order"""
+    if local_name(elem) is None or is_hidden(elem):
+        return
+    name = local_name(elem)
+    if name in GRAPHIC_TAGS:
+        yield elem
+    elif name in CONTAINER_TAGS:
+        for child in elem:
+            yield from iter_drawn(child)
+
+
+def _node_description(elem):
+    attrs = sorted((k, v) for k, v in elem.attrib.items()
+                   if k not in IGNORED_ATTRS
+                   and not k.startswith('{http://sodipodi'))
+    return repr((elem.tag, attrs, (elem.text or '').strip(),
+                 (elem.tail or '').strip())).encode('utf-8')
+
+
+def references(elem):
+    """Yield IDs and external URLs that the element refers to"""
+    for key, value in elem.attrib.items():
+        if key in _HREFS:
+            yield value
+        else:
+            for match in _URL_RE.finditer(value):
+                yield '#' + match.group(1)
+
+
+def canonical_parts(dom, elems, index):
+    """Yield canonical byte strings describing how the elements render
+
+    Includes the elements' visible subtrees, the attributes of their
+    ancestors (transforms, styles), and any resources (gradients,
+    patterns, linked images...) referenced from them.
+    Hidden parts and attributes irrelevant to rendering are left out.
+    """
+    yield _node_description(dom)
+    seen_refs = set()
+    pending_refs = []
+    for elem in elems:
+        yield b'element'
+        for ancestor in reversed(list(elem.iterancestors())):
+            yield _node_description(ancestor)
+        for node in iter_visible(elem):
+            yield _node_description(node)
+            pending_refs.extend(references(node))
+    while pending_refs:
+        ref = pending_refs.pop(0)
+        if ref in seen_refs:
+            continue
+        seen_refs.add(ref)
+        yield b'reference'
+        yield ref.encode('utf-8')
+        if ref.startswith('#'):
+            for target in index.find(ref[1:]):
+                for node in target.iter('*'):
+                    yield _node_description(node)
+                    pending_refs.extend(references(node))
+        else:
+            yield ('{}'.format(_file_fingerprint(ref))).encode('utf-8')
+
+
+def _file_fingerprint(url):
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    try:
+        return fingerprint_file(url)
+    except OSError:
+        return None
@@ -1,27 +1,201 @@
+import collections
 from concurrent.futures import ThreadPoolExecutor
+import io
+import itertools
+import os
 
-import librosa
 import numpy
-import scipy
+import scipy.stats
 
-from . import objects, templates, videos
+from . import analysis, dtw, objects, templates, videos
 from .objects import hash_bytes, run
-from .cdtw import dtw
 
-SAMPLE_RATE = 22050
+SAMPLE_RATE = analysis.SAMPLE_RATE
 DTW_HOP_RATIO = 3/4
 DTW_CUTOFF = 1/8
-STFT_HOP_LENGTH = 512
+STFT_HOP_LENGTH = analysis.HOP_LENGTH
 DTW_WINDOW_LENGTH = 240  # seconds
 
+DTW_MIN_BAND = 2  # seconds
+DTW_BAND_FACTOR = 4
+
+# Downsampling factors for multi-resolution DTW, coarsest first
+DTW_MULTIRES_FACTORS = 64, 8
+# Corridor around the projected path, in cells of the coarser level
+DTW_MULTIRES_RADIUS = 2
+
+# Cross-correlation offsets are checked with DTW on a few short windows
+XCORR_CHECK_WINDOWS = 8
+XCORR_CHECK_LENGTH = 30  # seconds
+# Minimum overlap of the recordings, as a fraction of the shorter one
+XCORR_MIN_OVERLAP = 1/2
+# A window confirms the offset if its DTW distance is below this fraction
+# of the distances at decoy offsets (half a window and a window away);
+# at least XCORR_MIN_CONFIRMED of the checked windows must confirm it
+XCORR_MAX_DISTANCE_RATIO = 0.9
+XCORR_MIN_CONFIRMED = 1/2
+
+# Parallel DTW windows are searched in a band around a constant offset,
+# and must agree to within a tolerance where they overlap
+DTW_PARALLEL_BAND = 30  # seconds
+DTW_PARALLEL_TOLERANCE = 0.1  # seconds
+
+# The anytime method stops when the regression's standard error has been
+# low enough for this many consecutive windows
+ANYTIME_STABLE_WINDOWS = 3
+ANYTIME_WINDOW_LENGTH = 60  # seconds
+
+# With voice activity gating, DTW windows need at least this fraction of
+# speech frames in both recordings, and the regression only uses path
+# points where both recordings have speech -- unless fewer than
+# VAD_MIN_ANCHORS of them are left
+VAD_MIN_WINDOW_SPEECH = 1/10
+VAD_MIN_ANCHORS = 1/10
+
+# Offsets found by sync_many must agree with direct syncs of other pairs
+MAX_CLOSURE_ERROR = 0.1  # seconds
+
+DEFAULT_SYNC_METHOD = 'multires'
+FAST_SYNC_METHOD = 'xcorr'
+# Methods seeded by cross-correlation give no path if the seed isn't
+# confirmed; get_audio_offset then tries these
+SYNC_FALLBACK_METHODS = {
+    'xcorr': 'multires',
+    'anytime': 'multires',
+}
+
 DTW_WINDOW_SIZE = DTW_WINDOW_LENGTH * SAMPLE_RATE // STFT_HOP_LENGTH
+DTW_MIN_BAND_SIZE = DTW_MIN_BAND * SAMPLE_RATE // STFT_HOP_LENGTH
+XCORR_CHECK_SIZE = XCORR_CHECK_LENGTH * SAMPLE_RATE // STFT_HOP_LENGTH
+DTW_PARALLEL_BAND_SIZE = DTW_PARALLEL_BAND * SAMPLE_RATE // STFT_HOP_LENGTH
+ANYTIME_WINDOW_SIZE = ANYTIME_WINDOW_LENGTH * SAMPLE_RATE // STFT_HOP_LENGTH
+DTW_PARALLEL_TOLERANCE_SIZE = (
+    DTW_PARALLEL_TOLERANCE * SAMPLE_RATE / STFT_HOP_LENGTH)
+
+thread_executor = ThreadPoolExecutor(os.cpu_count() or 1)
+
+# Result of syncing two videos: offset in seconds, regression slope and
+# standard error, and the sync method used
+SyncResult = collections.namedtuple('SyncResult', 'offset slope stderr method')
+
+# Result of sync_many: offsets (as for offset_videos), a SyncResult for
+# each video (None for the reference), and {(i, j): CrossCheck} for
+# pairs of non-reference videos that could be synced directly
+SyncReport = collections.namedtuple('SyncReport',
+                                    'offsets results cross_checks')
+
+# A direct sync of two videos, compared with the difference of their
+# offsets: closure error in seconds, and the direct sync's SyncResult
+CrossCheck = collections.namedtuple('CrossCheck', 'closure_error result')
+
 
-thread_executor = ThreadPoolExecutor(1)  # XXX: higher value
+def get_audio_offset(video_a, video_b, max_stderr=1e-5, max_speed_error=1e-3,
+                     method=DEFAULT_SYNC_METHOD, fast_method=FAST_SYNC_METHOD,
+                     vad=True, **options):
+    """Return the offset of video_a's audio relative to video_b's, in seconds
 
+    The ``fast_method`` is tried first (unless it's None). If its result
+    doesn't pass the checks, ``method`` is used, with the given options,
+    and then its fallback from SYNC_FALLBACK_METHODS (if any).
+    The 'anytime' method stops when its error is below ``max_stderr``.
+    ``vad`` enables voice activity gating (see SynchronizedObject).
+    """
+    return get_audio_sync(
+        video_a, video_b, max_stderr=max_stderr,
+        max_speed_error=max_speed_error, method=method,
+        fast_method=fast_method, vad=vad, **options).offset
+
+
+def get_audio_sync(video_a, video_b, max_stderr=1e-5, max_speed_error=1e-3,
+                   method=DEFAULT_SYNC_METHOD, fast_method=FAST_SYNC_METHOD,
+                   vad=True, **options):
+    """Like get_audio_offset, but return a SyncResult"""
+    if method == 'anytime':
+        options.setdefault('max_stderr', max_stderr)
+    attempts = [(method, options)]
+    if fast_method is not None and fast_method != method:
+        attempts.insert(0, (fast_method, {}))
+    fallback = SYNC_FALLBACK_METHODS.get(method)
+    if fallback is not None:
+        attempts.append((fallback, {}))
+    for i, (attempt, attempt_options) in enumerate(attempts):
+        sync = objects.registry.intern(
+            SynchronizedObject(video_a, video_b, method=attempt, vad=vad,
+                               **attempt_options))
+        try:
+            return _checked_sync(sync, max_stderr, max_speed_error)
+        except ValueError as e:
+            if i == len(attempts) - 1:
+                raise
+            print('{} (method {}); trying {}'.format(
+                e, attempt, attempts[i + 1][0]))
+
+
+def sync_many(videos, reference=0, max_stderr=1e-5, max_speed_error=1e-3,
+              method=DEFAULT_SYNC_METHOD, fast_method=FAST_SYNC_METHOD,
+              max_closure_error=MAX_CLOSURE_ERROR, vad=True):
+    """Sync several videos' audio to a reference; return a SyncReport
+
+    ``reference`` is the index of the reference video; its offset is 0.
+    Each other offset is what get_audio_offset(video, reference) returns,
+    so ``report.offsets`` can be passed to offset_videos.
+    Audio features of each video are only computed once.
+
+    The offsets are cross-checked: each pair of non-reference videos is
+    also synced with ``fast_method``, and the result must match the
+    difference of their offsets within ``max_closure_error`` seconds.
+    Cross-checks whose own standard error is over ``max_stderr`` can't
+    be trusted; they give a warning instead.
+    """
+    results = []
+    for i, video in enumerate(videos):
+        if i == reference:
+            results.append(None)
+        else:
+            print('Syncing source {} to source {}'.format(i, reference))
+            results.append(get_audio_sync(
+                video, videos[reference], max_stderr=max_stderr,
+                max_speed_error=max_speed_error, method=method,
+                fast_method=fast_method, vad=vad))
+    offsets = [0 if result is None else result.offset for result in results]
+    cross_checks = {}
+    if fast_method is not None:
+        for i, j in itertools.combinations(range(len(videos)), 2):
+            if reference in (i, j):
+                continue
+            sync = objects.registry.intern(SynchronizedObject(
+                videos[i], videos[j], method=fast_method, vad=vad))
+            try:
+                direct = _sync_result(sync)
+            except ValueError as e:
+                print('Warning: cannot cross-check sources {} and {}: '
+                      '{}'.format(i, j, e))
+                continue
+            error = abs(direct.offset - (offsets[i] - offsets[j]))
+            cross_checks[i, j] = CrossCheck(error, direct)
+            print('Sources {} and {}: closure error {} s, stderr {}'.format(
+                i, j, error, direct.stderr))
+            if not direct.stderr <= max_stderr:
+                print('Warning: cannot cross-check sources {} and {}: '
+                      'regression error too high ({})'.format(
+                          i, j, direct.stderr))
+            elif error > max_closure_error:
+                raise ValueError(
+                    'Audio sync: offsets of sources {} and {} disagree '
+                    'by {} s'.format(i, j, error))
+    return SyncReport(offsets, results, cross_checks)
+
+
+def _checked_sync(sync, max_stderr, max_speed_error):
+    result = _sync_result(sync)
+    if not result.stderr <= max_stderr:
+        raise ValueError('Audio sync: regression error too high')
+    if not abs(result.slope - 1) <= max_speed_error:
+        raise ValueError('Audio sync: Tracks have different speed')
+    return result
 
-def get_audio_offset(video_a, video_b, max_stderr=1e-5, max_speed_error=1e-3):
-    sync = SynchronizedObject(video_a, video_b)
 
+def _sync_result(sync):
     print(sync.filename)
     slope, intercept, r, stderr = sync.stats
     frames = intercept * 1
@@ -31,13 +205,8 @@ def get_audio_offset(video_a, video_b, max_stderr=1e-5, max_speed_error=1e-3):
         frames, frames_s))
     print('Speedup coefficient: {}'.format(r))
     print('Standard error of estimate: {}'.format(stderr))
-
-    if stderr > max_stderr:
-        raise ValueError('Audio sync: regression error too high')
-    if abs(slope - 1) > max_speed_error:
-        raise ValueError('Audio sync: Tracks have different speed')
-
-    return intercept * STFT_HOP_LENGTH / SAMPLE_RATE
+    return SyncResult(intercept * STFT_HOP_LENGTH / SAMPLE_RATE, slope, stderr,
+                      sync.method)
 
 def offset_video(video_a, video_b, offset, mode='pad'):
     if mode == 'pad':
@@ -68,6 +237,43 @@ def offset_video(video_a, video_b, offset, mode='pad'):
         raise ValueError('bad mode')
     return result_a, result_b
 
+def offset_videos(videos, offsets, mode='pad'):
+    """Like offset_video, for any number of videos
+
+    ``offsets`` are relative to a common reference, as in the result of
+    sync_many. ``mode`` is 'pad' (pad all videos to start together),
+    'intersect' (cut all to the part where all of them play), or the
+    index of a video whose timeline the others are cut or padded to.
+    """
+    # Delay of each video on a timeline where none starts before 0
+    shift = max(0, -min(offsets))
+    delays = [offset + shift for offset in offsets]
+    if mode == 'pad':
+        return [_pad_video(video, 1, delay)
+                for video, delay in zip(videos, delays)]
+    elif mode == 'intersect':
+        start = max(delays)
+        results = [_cut_video(video, 1, delay - start) if delay < start
+                   else video
+                   for video, delay in zip(videos, delays)]
+        end = min(result.duration for result in results)
+        return [result.trimmed(end=end) if end < result.duration else result
+                for result in results]
+    elif isinstance(mode, int):
+        main = videos[mode]
+        results = []
+        for i, (video, delay) in enumerate(zip(videos, delays)):
+            if i == mode:
+                results.append(video)
+                continue
+            result = _cut_video(video, 1, delay - delays[mode])
+            if main.duration < result.duration:
+                result = result.trimmed(end=main.duration)
+            results.append(result)
+        return results
+    else:
+        raise ValueError('bad mode')
+
 def _pad_video(video, side, offset):
     if offset * side <= 0:
         return video
@@ -88,76 +294,568 @@ def _cut_video(video, side, offset):
 
 
 class SynchronizedObject(objects.Object):
+    """DTW path between the audio of two videos
+
+    ``method`` is a key of SYNC_METHODS; ``options`` are passed to it.
+
+    With ``vad``, silent parts of the recordings are skipped where the
+    method allows it, and left out of the regression.
+    """
     ext = '.npy'
 
-    def __init__(self, video_a, video_b):
+    def __init__(self, video_a, video_b, method=DEFAULT_SYNC_METHOD,
+                 vad=True, **options):
+        self.features_a = get_features(video_a)
+        self.features_b = get_features(video_b)
+        if vad:
+            vad_params = (analysis.VAD_PERCENTILES, analysis.VAD_THRESHOLD,
+                          analysis.VAD_HANGOVER, VAD_MIN_WINDOW_SPEECH)
+        else:
+            vad_params = None
         self.hash = hash_bytes(
             type(self).__name__.encode('utf-8'),
-            video_a.hash.encode('utf-8'),
-            video_b.hash.encode('utf-8'),
+            self.features_a.hash.encode('utf-8'),
+            self.features_b.hash.encode('utf-8'),
+            method.encode('utf-8'),
+            repr(sorted(options.items())).encode('utf-8'),
+            repr(vad_params).encode('utf-8'),
         )
         self.video_a = video_a
         self.video_b = video_b
+        self.method = method
+        self.vad = vad
+        self.options = options
+
+    @property
+    def speech(self):
+        """Speech masks of both recordings, or None without VAD"""
+        if not self.vad:
+            return None
+        return self.features_a.speech_mask, self.features_b.speech_mask
 
     def save_to(self, filename):
-        data = get_data(self.video_a, self.video_b)
-        paths = get_wdwt_path(*data)
+        frames_a, frames_b = thread_executor.map(
+            lambda features: features.frames,
+            [self.features_a, self.features_b])
+        paths = SYNC_METHODS[self.method](frames_a, frames_b,
+                                          speech=self.speech, **self.options)
         with open(filename, 'wb') as f:
             numpy.save(f, paths)
         self._paths = paths
 
     @property
     def stats(self):
-        self.save()
+        return objects.registry.payload((self.hash, 'stats'), self._get_stats)
+
+    def _get_stats(self):
+        self.filename
         try:
             paths = self._paths
         except AttributeError:
-            with open(self.filename, 'rb') as f:
+            with io.BytesIO(self.read_bytes()) as f:
                 paths = numpy.load(f)
-        return regress(paths)
+        return path_stats(paths, self.speech)
+
+
+def get_features(video):
+    return analysis.get_analysis(video)
+
 
+def speech_anchors(paths, speech1, speech2, min_fraction=VAD_MIN_ANCHORS):
+    """Keep only path points where both recordings have speech
 
-def get_data(video_a, video_b):
-    opts = dict()
+    If too few points would be left, all of them are returned.
+    """
+    rows, cols = paths.astype(int)
+    keep = speech1[rows] & speech2[cols]
+    if keep.sum() < min_fraction * len(keep):
+        print('Too little speech; using all {} path points'.format(len(keep)))
+        return paths
+    print('Using {} of {} path points (speech in both)'.format(
+        keep.sum(), len(keep)))
+    return paths[:, keep]
 
-    def prepare_audio(video):
-        return video.mono_audio().exported_audio('s16',
-                                                 sample_rate=SAMPLE_RATE)
 
-    def load_data(audio):
-        signal, _sample_rate = librosa.load(audio.filename, sr=SAMPLE_RATE)
-        mfcc = librosa.feature.mfcc(signal, SAMPLE_RATE, n_mfcc=10,
-                                    hop_length=STFT_HOP_LENGTH)
-        return signal, mfcc.T
+def window_has_speech(speech, start1, start2, size):
+    """True if both windows have enough speech (or VAD is off)"""
+    if speech is None:
+        return True
+    speech1, speech2 = speech
+    return all(mask[start:start+size].mean() >= VAD_MIN_WINDOW_SPEECH
+               for mask, start in [(speech1, start1), (speech2, start2)]
+               if len(mask[start:start+size]))
 
-    data_a, data_b = thread_executor.map(
-        load_data, [prepare_audio(video_a), prepare_audio(video_b)])
 
-    return data_a, data_b
+def _speech_starts(starts, lag, size, speech):
+    """Filter window starts to those with speech on both sides
 
+    If no window has speech, all are returned.
+    """
+    result = [start1 for start1 in starts
+              if window_has_speech(speech, start1, start1 + lag, size)]
+    if len(result) < len(starts):
+        print('Skipping {} of {} windows without speech'.format(
+            len(starts) - len(result), len(starts)))
+    return result or starts
 
-def get_wdwt_path(data1, data2):
-    y1, f1 = data1
-    y2, f2 = data2
-    path1 = [0]
-    path2 = [0]
+
+def get_wdwt_path(f1, f2, speech=None):
+    path1 = []
+    path2 = []
     path_chunk_length = int(DTW_WINDOW_SIZE * DTW_HOP_RATIO)
-    while path1[-1] < len(f1) - 1 and path2[-1] < len(f2) - 1:
-        start1, start2 = [int(n) for n in [path1[-1], path2[-1]]]
-        print('Correlating... {}/{} {}/{} (~{}%), {} vs {}, sz {}'.format(
-            len(path1), len(f1), len(path2), len(f2),
-            int(min(len(path1)/len(f1), len(path2)/len(f2))*100),
-            start1, start2, DTW_WINDOW_SIZE))
-        dist, cost, path = dtw(f1[start1:start1+DTW_WINDOW_SIZE],
-                            f2[start2:start2+DTW_WINDOW_SIZE])
-        path1.extend(path[0][:path_chunk_length] + start1)
-        path2.extend(path[1][:path_chunk_length] + start2)
-    return numpy.array([path1, path2])
+    # The first window can be offset arbitrarily; later ones are searched
+    # in a band around the previous window's path
+    band = DTW_WINDOW_SIZE
+    slope = 1
+    start1 = start2 = 0
+    while start1 < len(f1) - 1 and start2 < len(f2) - 1:
+        print('Correlating... {}/{} {}/{} (~{}%), sz {}, band {}'.format(
+            start1, len(f1), start2, len(f2),
+            int(min(start1/len(f1), start2/len(f2))*100),
+            DTW_WINDOW_SIZE, band))
+        if not window_has_speech(speech, start1, start2, DTW_WINDOW_SIZE):
+            # Nothing to match; move on along the previous slope, but only
+            # put real matches in the path. The next window starts at a
+            # guess, so search all of it.
+            print('No speech; skipping window')
+            start1 += path_chunk_length
+            start2 += int(round(path_chunk_length * slope))
+            band = DTW_WINDOW_SIZE
+            continue
+        window1 = f1[start1:start1+DTW_WINDOW_SIZE]
+        window2 = f2[start2:start2+DTW_WINDOW_SIZE]
+        while True:
+            if band >= DTW_WINDOW_SIZE:
+                dist, path = dtw.dtw(window1, window2)
+                chunk = path[:, :path_chunk_length].astype(int)
+                break
+            lo, hi = dtw.band_limits(len(window1), len(window2), band, slope)
+            dist, path = dtw.dtw_corridor(window1, window2, lo, hi)
+            chunk = path[:, :path_chunk_length].astype(int)
+            if not _touches_corridor(chunk, lo, hi, len(window2)):
+                break
+            # The path was pushed against the edge; try again, wider
+            band *= 2
+        path1.extend(chunk[0] + start1)
+        path2.extend(chunk[1] + start2)
+        start1, start2 = int(path1[-1]), int(path2[-1])
+        slope, band = _next_band(chunk)
+    if not path1 and speech is not None:
+        # Like _speech_starts: if no window has speech, use all of them
+        print('No window has speech; correlating all of them')
+        return get_wdwt_path(f1, f2)
+    return numpy.array([path1, path2], dtype=int)
+
+
+def _touches_corridor(path, lo, hi, b_len):
+    """True if the path runs along a corridor edge inside the matrix"""
+    rows, cols = path
+    at_lo = (cols == lo[rows]) & (cols > 0)
+    at_hi = (cols == hi[rows] - 1) & (cols < b_len - 1)
+    return bool(numpy.any(at_lo | at_hi))
+
+
+def _next_band(path):
+    """Estimate the slope and band width for the window after a path"""
+    rows, cols = path
+    if rows[-1] - rows[0] <= 0 or cols[-1] - cols[0] <= 0:
+        return 1, DTW_WINDOW_SIZE
+    slope = (cols[-1] - cols[0]) / (rows[-1] - rows[0])
+    residual = numpy.abs(cols - cols[0] - slope * (rows - rows[0])).max()
+    band = max(DTW_MIN_BAND_SIZE, int(DTW_BAND_FACTOR * residual))
+    return slope, min(band, DTW_WINDOW_SIZE)
+
+
+def get_multires_path(f1, f2, factors=DTW_MULTIRES_FACTORS,
+                      radius=DTW_MULTIRES_RADIUS, speech=None):
+    """Find the DTW path coarse-to-fine
+
+    DTW is solved on block averages of the features (downsampled by the
+    largest factor), then refined at each finer level, within a corridor
+    around the path found at the previous level.
+    The path is cut off where either sequence ends, like get_wdwt_path's.
+    All of the path is computed, even in silence.
+    """
+    factors = [f for f in sorted(factors, reverse=True)
+               if min(len(f1), len(f2)) // f >= 2]
+    path = None
+    previous_factor = None
+    for factor in factors + [1]:
+        level1 = downsample(f1, factor)
+        level2 = downsample(f2, factor)
+        print('Correlating at 1/{} resolution: {} vs {}'.format(
+            factor, len(level1), len(level2)))
+        if path is None:
+            dist, path = dtw.dtw(level1, level2)
+        else:
+            lo, hi = project_path(path, previous_factor // factor,
+                                  radius, len(level1), len(level2))
+            dist, path = dtw.dtw_corridor(level1, level2, lo, hi)
+        previous_factor = factor
+    path = path.astype(int)
+    rows, cols = path
+    [ends] = numpy.nonzero((rows == len(f1) - 1) | (cols == len(f2) - 1))
+    return path[:, :ends[0] + 1]
+
+
+def downsample(features, factor):
+    """Average blocks of ``factor`` frames (the last block may be shorter)"""
+    if factor == 1:
+        return features
+    starts = numpy.arange(0, len(features), factor)
+    sums = numpy.add.reduceat(features, starts, axis=0)
+    counts = numpy.diff(numpy.append(starts, len(features)))
+    return sums / counts[:, numpy.newaxis]
+
+
+def project_path(path, factor, radius, a_len, b_len):
+    """Corridor limits around a coarse path, for a level ``factor``x finer
+
+    The corridor covers the cells under the path, widened by ``radius``
+    coarse cells in each direction.
+    """
+    rows, cols = path.astype(int)
+    coarse_len = (a_len + factor - 1) // factor
+    col_min = numpy.full(coarse_len, b_len, dtype=int)
+    col_max = numpy.zeros(coarse_len, dtype=int)
+    numpy.minimum.at(col_min, rows, cols)
+    numpy.maximum.at(col_max, rows, cols)
+    # Widen the corridor vertically...
+    widened_min = col_min.copy()
+    widened_max = col_max.copy()
+    for shift in range(1, radius + 1):
+        widened_min[shift:] = numpy.minimum(widened_min[shift:],
+                                            col_min[:-shift])
+        widened_min[:-shift] = numpy.minimum(widened_min[:-shift],
+                                             col_min[shift:])
+        widened_max[shift:] = numpy.maximum(widened_max[shift:],
+                                            col_max[:-shift])
+        widened_max[:-shift] = numpy.maximum(widened_max[:-shift],
+                                             col_max[shift:])
+    # ... and horizontally, and scale to the fine level
+    coarse_rows = numpy.arange(a_len) // factor
+    lo = (widened_min[coarse_rows] - radius) * factor
+    hi = (widened_max[coarse_rows] + 1 + radius) * factor
+    return dtw.connect_corridor(lo, hi, b_len)
+
+
+def get_xcorr_path(f1, f2, windows=XCORR_CHECK_WINDOWS,
+                   window_size=XCORR_CHECK_SIZE, band=DTW_MIN_BAND_SIZE,
+                   speech=None):
+    """Find DTW paths around a constant offset found by cross-correlation
+
+    The offset is estimated from the energy envelopes (the first MFCC),
+    and checked with check_lag; the middle halves of the check windows'
+    paths are returned. If the recordings aren't simply offset, the paths
+    won't follow a line, and the regression will show it.
+    If DTW doesn't confirm the offset, the path is empty, so it fails the
+    checks in get_audio_offset.
+    """
+    lag = xcorr_lag(f1[:, 0], f2[:, 0])
+    print('Cross-correlation: B is shifted by {} frames'.format(lag))
+    confirmed, path = check_lag(f1, f2, lag, windows, window_size, band,
+                                speech=speech)
+    if not confirmed:
+        print('Cross-correlation offset not confirmed')
+        return numpy.zeros((2, 0), dtype=int)
+    return path
+
+
+def check_lag(f1, f2, lag, windows=XCORR_CHECK_WINDOWS,
+              window_size=XCORR_CHECK_SIZE, band=DTW_MIN_BAND_SIZE,
+              speech=None):
+    """Check a constant offset with banded DTW on a few windows
+
+    The windows are spread over the overlapping part of the recordings.
+    Each one is also matched at decoy offsets; it confirms the lag if
+    the DTW distance there is clearly lower. (Within a narrow band, DTW
+    finds a near-diagonal path at any offset, so the path alone can't
+    tell a wrong offset.)
+
+    Returns (confirmed, path), where path has the middle halves of the
+    windows' paths at the lag.
+    """
+    start = max(0, -lag)
+    end = min(len(f1), len(f2) - lag)
+    window_size = min(window_size, end - start)
+    starts = numpy.linspace(start, end - window_size, windows).astype(int)
+    decoys = [-window_size, -window_size // 2,
+              window_size // 2, window_size]
+    path1 = []
+    path2 = []
+    checked = confirmed = 0
+    for start1 in _speech_starts(list(starts), lag, window_size, speech):
+        start2 = start1 + lag
+        print('Checking offset at {} vs {}, sz {}'.format(
+            start1, start2, window_size))
+        window1 = f1[start1:start1+window_size]
+        dist, path = dtw.dtw_banded(window1, f2[start2:start2+window_size],
+                                    band)
+        path = path.astype(int)
+        keep = slice(path.shape[1] // 4, path.shape[1] * 3 // 4)
+        path1.extend(path[0][keep] + start1)
+        path2.extend(path[1][keep] + start2)
+        decoy_dists = [
+            dtw.dtw_banded(window1, f2[start2+d:start2+d+window_size],
+                           band)[0]
+            for d in decoys
+            if 0 <= start2 + d <= len(f2) - window_size]
+        if decoy_dists:
+            checked += 1
+            ratio = dist / (min(decoy_dists) or 1)
+            print('Distance ratio to decoys: {}'.format(ratio))
+            if ratio < XCORR_MAX_DISTANCE_RATIO:
+                confirmed += 1
+    is_confirmed = checked > 0 and confirmed >= checked * XCORR_MIN_CONFIRMED
+    return is_confirmed, numpy.array([path1, path2])
+
+
+def xcorr_lag(envelope1, envelope2, min_overlap=XCORR_MIN_OVERLAP):
+    """Return the lag that best aligns envelope2 to envelope1
+
+    That is, envelope2[i + lag] corresponds to envelope1[i].
+    """
+    len1 = len(envelope1)
+    len2 = len(envelope2)
+    e1 = (envelope1 - envelope1.mean()) / (envelope1.std() or 1)
+    e2 = (envelope2 - envelope2.mean()) / (envelope2.std() or 1)
+    size = 1 << (len1 + len2 - 1).bit_length()
+    corr = numpy.fft.irfft(
+        numpy.conj(numpy.fft.rfft(e1, size)) * numpy.fft.rfft(e2, size),
+        size)
+    lags = numpy.arange(size)
+    lags[lags >= len2] -= size
+    overlap = numpy.minimum(len1, len2 - lags) - numpy.maximum(0, -lags)
+    valid = overlap >= max(1, min_overlap * min(len1, len2))
+    if not valid.any():
+        raise ValueError('Audio sync: recordings too short')
+    scores = numpy.where(valid, corr / numpy.maximum(overlap, 1), -numpy.inf)
+    return int(lags[numpy.argmax(scores)])
+
+
+def get_parallel_path(f1, f2, window_size=DTW_WINDOW_SIZE,
+                      band=DTW_PARALLEL_BAND_SIZE,
+                      tolerance=DTW_PARALLEL_TOLERANCE_SIZE, speech=None):
+    """Find the DTW path in independent windows, in parallel
+
+    Windows overlap by half, and are seeded by a cross-correlation offset
+    (so they don't depend on each other). Each window contributes the
+    middle of its path; where consecutive windows overlap, their paths
+    must agree. If they don't, or if check_lag doesn't confirm the
+    offset, get_wdwt_path is used instead.
+    Windows without speech are skipped, leaving gaps in the path.
+    """
+    lag = xcorr_lag(f1[:, 0], f2[:, 0])
+    confirmed, path = check_lag(f1, f2, lag, speech=speech)
+    if not confirmed:
+        print('Cross-correlation offset not confirmed; '
+              'correlating sequentially')
+        return get_wdwt_path(f1, f2, speech=speech)
+    start = max(0, -lag)
+    end = min(len(f1), len(f2) - lag)
+    window_size = min(window_size, end - start)
+    step = window_size // 2
+    starts = list(range(start, end - window_size, step)) + [end - window_size]
+    starts = _speech_starts(starts, lag, window_size, speech)
+
+    def solve(start1):
+        start2 = start1 + lag
+        print('Correlating window {} vs {}, sz {}'.format(
+            start1, start2, window_size))
+        dist, path = dtw.dtw_banded(f1[start1:start1+window_size],
+                                f2[start2:start2+window_size], band)
+        path = path.astype(int)
+        path[0] += start1
+        path[1] += start2
+        return path
+
+    paths = list(thread_executor.map(solve, starts))
+
+    margin = window_size // 8
+    for start1, path, next_start, next_path in zip(
+            starts, paths, starts[1:], paths[1:]):
+        rows = numpy.arange(next_start + margin,
+                            start1 + window_size - margin)
+        if not len(rows):
+            continue
+        difference = numpy.abs(_path_columns(path, rows) -
+                               _path_columns(next_path, rows))
+        if numpy.median(difference) > tolerance:
+            print('Windows at {} and {} disagree; correlating sequentially'
+                  .format(start1, next_start))
+            return get_wdwt_path(f1, f2, speech=speech)
+
+    result = []
+    keep_start = 0
+    for i, (start1, path) in enumerate(zip(starts, paths)):
+        if i == len(starts) - 1 or starts[i + 1] > start1 + step:
+            # Last window, or the next one was skipped
+            keep_end = start1 + window_size
+        else:
+            keep_end = start1 + window_size * 3 // 4
+        kept = (path[0] >= keep_start) & (path[0] < keep_end)
+        result.append(path[:, kept])
+        keep_start = keep_end
+    return numpy.concatenate(result, axis=1)
+
+
+def _path_columns(path, rows):
+    """Return the column where the path enters each of the given rows"""
+    return path[1][numpy.searchsorted(path[0], rows)]
+
+
+def get_anytime_path(f1, f2, max_stderr=1e-5,
+                     stable_windows=ANYTIME_STABLE_WINDOWS,
+                     window_size=ANYTIME_WINDOW_SIZE,
+                     band=DTW_PARALLEL_BAND_SIZE, spread=True, speech=None):
+    """Find DTW paths window by window, until the regression is stable
+
+    Windows are seeded by a cross-correlation offset (if check_lag doesn't
+    confirm it, the path is empty, like get_xcorr_path's). The middle half
+    of each window's path is added to an IncrementalRegression (of the
+    speech anchors, as in path_stats, but without trimming the ends); once
+    its standard error stays below ``max_stderr`` for ``stable_windows``
+    consecutive windows, the remaining windows are skipped.
+    With ``spread``, windows are taken from all over the recording
+    (first, last, middle, quarters...) rather than from the start.
+
+    Use a full-path method (like 'multires') to look at drift.
+    """
+    lag = xcorr_lag(f1[:, 0], f2[:, 0])
+    confirmed, path = check_lag(f1, f2, lag, speech=speech)
+    if not confirmed:
+        print('Cross-correlation offset not confirmed')
+        return numpy.zeros((2, 0), dtype=int)
+    start = max(0, -lag)
+    end = min(len(f1), len(f2) - lag)
+    window_size = min(window_size, end - start)
+    starts = list(range(start, end - window_size, window_size))
+    starts.append(end - window_size)
+    starts = _speech_starts(starts, lag, window_size, speech)
+    if spread:
+        starts = [starts[i] for i in _spread_order(len(starts))]
+
+    paths = []
+    # All points, and speech anchors; like speech_anchors, the anchors are
+    # used unless there are too few of them
+    regression = IncrementalRegression()
+    anchor_regression = IncrementalRegression()
+    stable = 0
+    for start1 in starts:
+        start2 = start1 + lag
+        dist, path = dtw.dtw_banded(f1[start1:start1+window_size],
+                                    f2[start2:start2+window_size], band)
+        path = path.astype(int)
+        path = path[:, path.shape[1] // 4:path.shape[1] * 3 // 4]
+        path[0] += start1
+        path[1] += start2
+        paths.append(path)
+        regression.add(*path)
+        if speech is not None:
+            keep = speech[0][path[0]] & speech[1][path[1]]
+            anchor_regression.add(*path[:, keep])
+        if anchor_regression.count >= VAD_MIN_ANCHORS * regression.count:
+            slope, intercept, r, stderr = anchor_regression.stats
+        else:
+            slope, intercept, r, stderr = regression.stats
+        print('Window {} vs {}: slope {}, offset {}, stderr {}'.format(
+            start1, start2, slope, intercept, stderr))
+        if stderr <= max_stderr:
+            stable += 1
+            if stable >= stable_windows:
+                break
+        else:
+            stable = 0
+    if not paths:
+        return numpy.zeros((2, 0), dtype=int)
+    result = numpy.concatenate(paths, axis=1)
+    return result[:, numpy.argsort(result[0], kind='stable')]
+
+
+def _spread_order(count):
+    """Order range(count) so that each prefix is spread out evenly"""
+    bits = max(count - 1, 0).bit_length()
+    def reversed_bits(i):
+        return int('{:0{}b}'.format(i, bits)[::-1], 2) if bits else 0
+    return sorted(range(count), key=reversed_bits)
+
+
+class IncrementalRegression:
+    """Linear regression of y on x, updated as batches of points arrive
+
+    ``stats`` gives the same slope, intercept, r and standard error as
+    scipy.stats.linregress would on all the points so far.
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean_x = self.mean_y = 0
+        # Sums of squared deviations, and of products of deviations
+        self.ss_x = self.ss_y = self.ss_xy = 0
+
+    def add(self, x, y):
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        count = len(x)
+        if not count:
+            return
+        mean_x = x.mean()
+        mean_y = y.mean()
+        total = self.count + count
+        delta_x = mean_x - self.mean_x
+        delta_y = mean_y - self.mean_y
+        weight = self.count * count / total
+        self.ss_x += ((x - mean_x) ** 2).sum() + delta_x ** 2 * weight
+        self.ss_y += ((y - mean_y) ** 2).sum() + delta_y ** 2 * weight
+        self.ss_xy += (((x - mean_x) * (y - mean_y)).sum() +
+                       delta_x * delta_y * weight)
+        self.mean_x += delta_x * count / total
+        self.mean_y += delta_y * count / total
+        self.count = total
+
+    @property
+    def stats(self):
+        """Return (slope, intercept, r, stderr), like regress"""
+        if self.count < 3 or not self.ss_x:
+            return numpy.nan, numpy.nan, numpy.nan, numpy.inf
+        slope = self.ss_xy / self.ss_x
+        intercept = self.mean_y - slope * self.mean_x
+        if self.ss_y:
+            r = min(1.0, max(-1.0, self.ss_xy / numpy.sqrt(
+                self.ss_x * self.ss_y)))
+        else:
+            r = 0.0
+        stderr = numpy.sqrt((1 - r ** 2) * self.ss_y / self.ss_x /
+                            (self.count - 2))
+        return slope, intercept, r, stderr
+
+
+# Each method is called as method(features1, features2, speech=..., **options)
+# where speech is a pair of masks from analysis.speech_mask, or None
+SYNC_METHODS = {
+    'windowed': get_wdwt_path,
+    'parallel': get_parallel_path,
+    'multires': get_multires_path,
+    'xcorr': get_xcorr_path,
+    'anytime': get_anytime_path,
+}
+
+
+def path_stats(paths, speech=None):
+    """Regression of a path, on the points get_audio_offset checks
+
+    With speech masks, only speech anchors are used (see speech_anchors).
+    """
+    if speech is not None:
+        paths = speech_anchors(paths, *speech)
+    return regress(paths)
 
 
 def regress(paths):
     length = paths.shape[1]
     cutoff = int(length * DTW_CUTOFF)
+    trimmed = paths[:, cutoff:length - cutoff]
+    if trimmed.shape[1] < 2:
+        raise ValueError('Audio sync: not enough matched points')
     slope, intercept, r, p, stderr = scipy.stats.linregress(
-        paths[:,cutoff:-cutoff])
+        trimmed[0], trimmed[1])
     return slope, intercept, r, stderr
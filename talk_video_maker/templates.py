@@ -1,10 +1,13 @@
+import collections
+import copy
 import csv
 import math
+import threading
 
 import lxml.etree
 
-from . import objects
-from .objects import hash_bytes, run
+from . import objects, inkscape, rasterizers, svg
+from .objects import hash_bytes
 
 class Template(objects.Object):
     is_big_file = False
@@ -26,15 +29,12 @@ class Template(objects.Object):
         return AttrReplacedTemplate(self, id, attr, value)
 
     def _dom_copy(self):
-        return lxml.etree.XML(lxml.etree.tostring(self.dom))
+        return copy.deepcopy(self.dom)
 
     @property
     def dom(self):
-        try:
-            return self._dom
-        except AttributeError:
-            self._dom = self.get_dom()
-            return self._dom
+        return objects.registry.payload((self.hash, 'dom'), self.get_dom,
+                                        size=dom_size)
 
     def save_to(self, filename):
         str = lxml.etree.tostring(self.dom, pretty_print=True)
@@ -54,25 +54,83 @@ class Template(objects.Object):
             width = self.element_sizes[id]['w']
         if height is None:
             height = self.element_sizes[id]['h']
+        rasterizer = rasterizers.choose_rasterizer(self, id)
         def write_image(filename):
-            args = ['inkscape',
-                    self.filename,
-                    '--export-png', filename,
-                    '--export-background-opacity', '0',
-                    '--export-width', str(width),
-                    '--export-height', str(height),
-                    ]
-            if id is not None:
-                args.extend(['--export-area-snap',
-                             '--export-id', id])
+            rasterizer.render(self, filename, id=id,
+                              width=width, height=height)
+        pic_hash = self.picture_key(id, width, height, rasterizer)
+        image = GeneratedImage(pic_hash.encode('utf-8'), write_image,
+                               size=(width, height),
+                               batch_key=(rasterizer.name, self.hash))
+        return objects.registry.intern(image).deferred()
+
+    def picture_key(self, id, width, height, rasterizer):
+        """Hash everything that can show up in an exported picture
+
+        Only visible elements that can overlap the exported area count,
+        so variants that look the same there (e.g. ones reached by
+        different edits, or differing only elsewhere) share pictures.
+        """
+        area = None if id is None else self.element_sizes[id]
+        return hash_bytes(
+            b'picture',
+            rasterizer.name.encode('utf-8'),
+            str(width).encode('utf-8'),
+            str(height).encode('utf-8'),
+            repr(sorted(area.items()) if area else None).encode('utf-8'),
+            *svg.canonical_parts(self.dom, self.drawn_elements(id),
+                                 self.element_index))
+
+    def drawn_elements(self, id=None):
+        """Return visible graphic elements that can show up in an export
+
+        With an id, these are the element itself, its ancestors and
+        descendants, and elements that (might) overlap its area.
+        """
+        dom = self.dom
+        if id is None:
+            return list(svg.iter_drawn(dom))
+        area = self.element_sizes[id]
+        targets = self.element_index.find(id)
+        if not targets:
+            raise LookupError('element {} not found in SVG'.format(id))
+        [target, *_] = targets
+        elems = []
+        for elem in svg.iter_drawn(dom):
+            if (elem is target or target in elem.iterancestors() or
+                    elem in target.iterancestors()):
+                elems.append(elem)
             else:
-                args.extend(['--export-area-page'])
-            run(args)
-        pic_hash = hash_bytes(self.hash.encode('utf-8'),
-                              id.encode('utf-8') if id else b'',
-                              str(width).encode('utf-8'),
-                              str(height).encode('utf-8'))
-        return GeneratedImage(pic_hash.encode('utf-8'), write_image)
+                bbox = self._drawn_bbox(dom, elem)
+                if bbox is None or svg.intersects(bbox, area):
+                    elems.append(elem)
+        return elems
+
+    def _drawn_bbox(self, dom, elem):
+        """Bounding box of a drawn element, or None if not cheaply known"""
+        name = svg.local_name(elem)
+        if name in ('rect', 'image'):
+            bbox = svg.element_bbox(dom, elem)
+            if bbox is not None:
+                return bbox
+        elif name == 'flowRoot':
+            bbox = svg.flowed_text_bbox(dom, elem)
+            if bbox is not None:
+                return bbox
+        elem_id = elem.get('id')
+        if elem_id is not None and self.geometry_source(elem_id) is self.base:
+            try:
+                geometry = self.base.element_geometry(elem_id)
+            except KeyError:
+                return None
+            return {k: float(v) for k, v in geometry.items()}
+        return None
+
+    @property
+    def element_index(self):
+        return objects.registry.payload(
+            (self.hash, 'index'), lambda: svg.ElementIndex(self.dom),
+            size=lambda index: 100 * len(index))
 
     @property
     def width(self):
@@ -84,7 +142,43 @@ class Template(objects.Object):
 
     @property
     def element_sizes(self):
-        return TemplateElementSizes(self)
+        return objects.registry.intern(TemplateElementSizes(self))
+
+    # Unmodified templates are their own base, with no edits
+    edits = ()
+
+    @property
+    def base(self):
+        return self
+
+    def geometry_source(self, id):
+        """Return the earliest variant with the same geometry for ``id``
+
+        Walks up the chain of modifications, skipping those that can't
+        change the given element's bounding box.
+        """
+        template = self
+        while (isinstance(template, ModifiedTemplate) and
+                not template.affects_geometry(id)):
+            template = template.parent
+        return template
+
+    def element_geometry(self, id):
+        """Return the bounding box of an element, as reported by Inkscape
+
+        Simple elements are measured in-process; others are queried using
+        Inkscape (on the earliest variant with the same geometry).
+        """
+        source = self.geometry_source(id)
+        bbox = svg.plain_bbox(source.dom, id)
+        if bbox is None:
+            bbox = objects.registry.intern(TemplateElementSizes(source)).data[id]
+        return bbox
+
+
+def dom_size(dom):
+    """Rough estimate of the memory taken by a DOM, in bytes"""
+    return 1000 * sum(1 for elem in dom.iter())
 
 
 class InputTemplate(Template, objects.InputObject):
@@ -93,13 +187,55 @@ class InputTemplate(Template, objects.InputObject):
 
 
 class ModifiedTemplate(Template):
+    """A template variant: an unmodified base template plus a list of edits
+
+    Each ModifiedTemplate is itself the last edit in its list.
+    """
+    def __init__(self, parent):
+        self.parent = parent
+        self._base = parent.base
+        self.edits = parent.edits + (self, )
+
+    @property
+    def base(self):
+        return self._base
+
     def get_dom(self):
-        return self._dom_copy()
+        # Start from the closest variant whose DOM is at hand, copy it once,
+        # and apply the rest of the edits
+        edits = self.edits
+        start = self.base
+        for i in range(len(edits) - 1, 0, -1):
+            if (edits[i - 1].hash, 'dom') in objects.registry.payloads:
+                start = edits[i - 1]
+                edits = edits[i:]
+                break
+        dom = start._dom_copy()
+        index = svg.ElementIndex(dom)
+        for edit in edits:
+            edit.apply(dom, index)
+        return dom
 
+    def apply(self, dom, index):
+        """Apply this edit to the DOM, keeping the ID index up to date"""
+        raise NotImplementedError()
 
-class RetextedTemplate(ModifiedTemplate):
+    def affects_geometry(self, id):
+        """True if this modification might change the element's bounding box
+        """
+        return True
+
+
+class _ElementModifiedTemplate(ModifiedTemplate):
+    def affects_geometry(self, id):
+        # Changing an element can change its own bounding box,
+        # and those of its descendants and ancestors
+        return svg.are_related(self.base.element_index, self.id, id)
+
+
+class RetextedTemplate(_ElementModifiedTemplate):
     def __init__(self, parent, id, text):
-        self.parent = parent
+        super().__init__(parent)
         self.id = id
         self.text = text
         self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
@@ -107,17 +243,14 @@ class RetextedTemplate(ModifiedTemplate):
                                id.encode('utf-8'),
                                text.encode('utf-8'))
 
-    def _dom_copy(self):
-        dom = self.parent._dom_copy()
-        xpath = './/*[@id="{}"]'.format(self.id)
-        elems = dom.xpath(xpath)
+    def apply(self, dom, index):
+        elems = index.find(self.id)
         if not elems:
             raise LookupError('element {} not found in SVG'.format(self.id))
-        for elem in dom.xpath(xpath):
+        for elem in elems:
             regions = elem.findall('./{*}flowPara')
             [elem] = regions
             elem.text = self.text
-        return dom
 
     def __repr__(self):
         return '{s.parent}{{{s.id}->{s.text!r}}}'.format(s=self)
@@ -125,29 +258,30 @@ class RetextedTemplate(ModifiedTemplate):
 
 class ReducedTemplate(ModifiedTemplate):
     def __init__(self, parent, id):
-        self.parent = parent
+        super().__init__(parent)
         self.id = id
         self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
                                self.parent.hash.encode('utf-8'),
                                id.encode('utf-8'))
 
-    def _dom_copy(self):
-        dom = self.parent._dom_copy()
-        xpath = './/*[@id="{}"]'.format(self.id)
-        for elem in dom.xpath(xpath):
+    def apply(self, dom, index):
+        for elem in index.find(self.id):
             if 'style' in elem.attrib:
                 elem.attrib['style'] += ';opacity:0'
             else:
                 elem.attrib['style'] = 'opacity:0'
-        return dom
+
+    def affects_geometry(self, id):
+        # Opacity doesn't change bounding boxes
+        return False
 
     def __repr__(self):
         return '{s.parent}{{-{s.id}}}'.format(s=self)
 
 
-class ImageReplacedTemplate(ModifiedTemplate):
+class ImageReplacedTemplate(_ElementModifiedTemplate):
     def __init__(self, parent, id, image):
-        self.parent = parent
+        super().__init__(parent)
         self.id = id
         self.image = image
         self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
@@ -155,33 +289,35 @@ class ImageReplacedTemplate(ModifiedTemplate):
                                id.encode('utf-8'),
                                image.hash.encode('utf-8'))
 
-    def _dom_copy(self):
-        dom = self.parent._dom_copy()
-        xpath = './/*[@id="{}"]'.format(self.id)
-        for elem in dom.xpath(xpath):
+    def apply(self, dom, index):
+        # Refer to the image in the persistent (disk) tier: the SVG is
+        # itself cached, and might outlive the fast tier
+        self.image.save()
+        href = self.image.get_filename()
+        for elem in index.find(self.id):
             width = elem.attrib['width']
             height = elem.attrib['height']
             x = elem.attrib['x']
             y = elem.attrib['y']
             elem.tag = 'image'
             elem.attrib.clear()
+            index.remove(self.id, elem)
             elem.attrib.update({
-                '{http://www.w3.org/1999/xlink}href': self.image.filename,
+                '{http://www.w3.org/1999/xlink}href': href,
                 'width': str(width),
                 'height': str(height),
                 'x': str(x),
                 'y': str(y),
                 'preserveAspectRatio': 'none',
             })
-        return dom
 
     def __repr__(self):
         return '{s.parent}{{-{s.id}}}'.format(s=self)
 
 
-class AttrReplacedTemplate(ModifiedTemplate):
+class AttrReplacedTemplate(_ElementModifiedTemplate):
     def __init__(self, parent, id, attr, value):
-        self.parent = parent
+        super().__init__(parent)
         self.id = id
         self.attr = attr
         self.value = str(value)
@@ -191,12 +327,12 @@ class AttrReplacedTemplate(ModifiedTemplate):
                                attr.encode('utf-8'),
                                self.value.encode('utf-8'))
 
-    def _dom_copy(self):
-        dom = self.parent._dom_copy()
-        xpath = './/*[@id="{}"]'.format(self.id)
-        for elem in dom.xpath(xpath):
+    def apply(self, dom, index):
+        for elem in index.find(self.id):
             elem.attrib[self.attr] = self.value
-        return dom
+            if self.attr == 'id':
+                index.remove(self.id, elem)
+                index.add(self.value, elem)
 
     def __repr__(self):
         return '{s.parent}{{-{s.id}}}'.format(s=self)
@@ -204,7 +340,7 @@ class AttrReplacedTemplate(ModifiedTemplate):
 
 class ResizedTemplate(ModifiedTemplate):
     def __init__(self, parent, width, height):
-        self.parent = parent
+        super().__init__(parent)
         self.new_width = width
         self.new_height = height
         self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
@@ -212,11 +348,13 @@ class ResizedTemplate(ModifiedTemplate):
                                str(width).encode('utf-8'),
                                str(height).encode('utf-8'))
 
-    def _dom_copy(self):
-        dom = self.parent._dom_copy()
+    def apply(self, dom, index):
         dom.attrib['width'] = str(self.new_width)
         dom.attrib['height'] = str(self.new_height)
-        return dom
+
+    def affects_geometry(self, id):
+        # Without a viewBox, the size of the page doesn't scale the drawing
+        return 'viewBox' in self.base.dom.attrib
 
 
 class TemplateElementSizes(objects.Object):
@@ -229,29 +367,37 @@ class TemplateElementSizes(objects.Object):
                                b'sizes')
 
     def save_to(self, filename):
-        data = run(['inkscape', '--query-all', self.template.filename])
+        data = inkscape.query_all(self.template.filename,
+                                  self._expected_ids())
         self._csv = data.decode('utf-8')
         with open(filename, 'wb') as f:
             f.write(data)
 
+    def _expected_ids(self):
+        """IDs that must be in Inkscape's output: plain visible boxes"""
+        dom = self.template.dom
+        ids = []
+        for elem in svg.iter_drawn(dom):
+            bbox = svg.element_bbox(dom, elem)
+            if elem.get('id') and bbox and bbox['w'] > 0 and bbox['h'] > 0:
+                ids.append(elem.get('id'))
+        return ids
+
     @property
     def data(self):
+        return objects.registry.payload((self.hash, 'data'), self._load_data,
+                                        size=lambda data: 200 * len(data))
+
+    def _load_data(self):
+        self.filename
         try:
-            return self._data
+            csv_text = self._csv
         except AttributeError:
-            self.save()
-            try:
-                csv_text = self._csv
-            except AttributeError:
-                with open(self.filename) as f:
-                    csv_lines = list(f)
-            else:
-                csv_lines = csv_text.splitlines()
-            data = {}
-            for name, x, y, w, h in csv.reader(csv_lines):
-                data[name] = {'x': x, 'y': y, 'w': w, 'h': h}
-            self._data = data
-            return self._data
+            csv_text = self.read_bytes().decode('utf-8')
+        data = {}
+        for name, x, y, w, h in csv.reader(csv_text.splitlines()):
+            data[name] = {'x': x, 'y': y, 'w': w, 'h': h}
+        return data
 
     def __getitem__(self, id):
         return {k: self.get(id, k) for k in 'xywh'}
@@ -267,20 +413,59 @@ class TemplateElementSizes(objects.Object):
             else:
                 raise LookupError(size)
         else:
-            value = float(self.data[id][size])
+            value = float(self.template.element_geometry(id)[size])
             if size in 'wh':
                 value = math.ceil(value)
             return int(value)
 
 
 class GeneratedImage(objects.Object):
+    """Image made by a function
+
+    If a size is given, the image can be deferred: it is then only
+    generated when needed, or when ``export_pending`` is called.
+    Deferred images with the same ``batch_key`` are generated together.
+    """
     ext = '.png'
 
-    def __init__(self, hash_part, write_func):
+    def __init__(self, hash_part, write_func, *, size=None, batch_key=None):
         self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
                                hash_part)
         self.write_func = write_func
-        self.save()
+        self.size = size
+        self.batch_key = batch_key
+
+    def deferred(self):
+        if not hasattr(self, '_filename'):
+            with _pending_lock:
+                _pending_images.setdefault(self.hash, self)
+        return self
+
+    def save(self):
+        export_pending()
+        return super().save()
 
     def save_to(self, filename):
         self.write_func(filename)
+
+
+_pending_images = {}
+_pending_lock = threading.Lock()
+
+
+def export_pending():
+    """Generate all deferred images, in batches on the Inkscape pool"""
+    with _pending_lock:
+        images = list(_pending_images.values())
+        _pending_images.clear()
+    if not images:
+        return
+    batches = collections.OrderedDict()
+    for image in images:
+        batches.setdefault(image.batch_key, []).append(image)
+    inkscape.pool.map_batches(_save_images, batches.values())
+
+
+def _save_images(images):
+    for image in images:
+        image.filename
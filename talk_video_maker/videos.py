@@ -1,8 +1,10 @@
 import json
 import collections
+from concurrent.futures import ThreadPoolExecutor
 import itertools
 import functools
 import re
+import subprocess
 
 from . import objects, templates
 from .objects import hash_bytes, run
@@ -96,6 +98,12 @@ class AVObject(objects.Object):
         ))
         return AVObject(streams)
 
+    def with_volume(self, gain):
+        """Change the audio volume by ``gain`` decibels"""
+        streams = filter_streams(self.streams, {'audio'}, 'volume',
+                                 {'volume': '{}dB'.format(gain)})
+        return AVObject(streams)
+
     def exported_audio(self, format, sample_rate=None):
         args = {'sample_fmts': format}
         if sample_rate:
@@ -191,6 +199,37 @@ class AVObject(objects.Object):
 
     def save_to(self, filename):
         print(filename)
+        graph_args, maps = self._ffmpeg_graph()
+        run(['ffmpeg'] + graph_args + [
+             '-f', FORMAT_PARAMS.get(self.format, self.format),
+             '-c:v', 'libx264',
+             '-c:a', self.acodec,
+             '-b:a', '240k',
+             '-crf', '30',
+             #'-maxrate', '500k',
+             '-bufsize', '1835k',
+             '-strict', '-2',
+             ] + maps + [
+             filename])
+        return
+
+    def open_raw_audio(self, sample_rate):
+        """Start ffmpeg, streaming the audio as raw mono s16le to a pipe
+
+        Returns the Popen object; read the samples from its stdout.
+        """
+        audio = self.mono_audio().exported_audio('s16', sample_rate=sample_rate)
+        graph_args, maps = audio._ffmpeg_graph()
+        return objects.popen(['ffmpeg', '-nostdin'] + graph_args + [
+                              '-f', 's16le',
+                              '-c:a', 'pcm_s16le',
+                              ] + maps + [
+                              'pipe:1'],
+                             stdout=subprocess.PIPE)
+
+    def _ffmpeg_graph(self):
+        """Return ffmpeg arguments for the filter graph, and output maps"""
+        templates.export_pending()
 
         streams = self.streams
         streams = filter_streams(streams, {'video'}, 'setpts',
@@ -206,19 +245,7 @@ class AVObject(objects.Object):
         maps = []
         for i, s in enumerate(streams):
             maps.extend(['-map', '[out{}]'.format(i)])
-        run(['ffmpeg',
-             '-filter_complex', specs,
-             '-f', FORMAT_PARAMS.get(self.format, self.format),
-             '-c:v', 'libx264',
-             '-c:a', self.acodec,
-             '-b:a', '240k',
-             '-crf', '30',
-             #'-maxrate', '500k',
-             '-bufsize', '1835k',
-             '-strict', '-2',
-             ] + maps + [
-             filename])
-        return
+        return ['-filter_complex', specs], maps
 
     @property
     def width(self):
@@ -261,7 +288,8 @@ class InputVideo(AVObject, objects.InputObject):
     is_big_file = True
     def __init__(self, filename):
         self.filename = filename
-        streams = filter_movie(filename).outputs
+        self.fingerprint = fingerprint_input(filename)
+        streams = filter_movie(filename, fingerprint=self.fingerprint).outputs
         streams = filter_streams(streams, {'video'}, 'fps',
                                  {'fps': '25'})
         streams = filter_streams(streams, {'video'}, 'format',
@@ -270,6 +298,15 @@ class InputVideo(AVObject, objects.InputObject):
         super().__init__(streams)
 
 
+def fingerprint_input(filename):
+    """Fingerprint an input file (or all parts of a "concat:" input)"""
+    if filename.startswith('concat:'):
+        parts = filename[len('concat:'):].split('|')
+        return hash_bytes(b'concat', *(objects.fingerprint_file(p).encode('utf-8')
+                                       for p in parts))
+    return objects.fingerprint_file(filename)
+
+
 class BlankVideo(AVObject):
     def __init__(self, duration, *, width, height):
         streams = filter_color(duration, width, height).outputs
@@ -332,7 +369,15 @@ class OverlaidAV(AVObject):
 
 class ImageVideo(AVObject):
     def __init__(self, image, duration, fps):
-        img = filter_movie(image.filename, ['dv'], duration=duration)
+        size = getattr(image, 'size', None)
+        if size is None:
+            filename = image.filename
+        else:
+            # The size is known, so the image does not need to exist yet
+            # (and it can be generated in a batch with others)
+            filename = image.get_filename()
+        img = filter_movie(filename, ['dv'], duration=duration,
+                           fingerprint=image.hash, size=size)
         blank = generate_blank(duration, *img.outputs[0].size, fps=fps)
         overlay = filter_overlay(blank.outputs + img.outputs, repeatlast=True)
         streams = overlay.outputs
@@ -343,8 +388,14 @@ def make_image_video(image, duration):
     return ImageVideo(image, duration, fps=25)
 
 class Stream:
+    # Streams are created by a Filter, which sets their source exactly once.
+    # The hash is computed on first use and then remembered.
+    __slots__ = ('source', 'size', 'duration', '_hash')
+
     attr_names = frozenset()
 
+    _incomplete_hashes = {}
+
     def __repr__(self):
         try:
             source = self.source
@@ -358,13 +409,24 @@ class Stream:
 
     @property
     def incomplete_hash(self):
-        return hash_bytes(type(self).__name__.encode('utf-8'),
-                          self.type.encode('utf-8'))
+        cls = type(self)
+        try:
+            return Stream._incomplete_hashes[cls]
+        except KeyError:
+            result = hash_bytes(cls.__name__.encode('utf-8'),
+                                self.type.encode('utf-8'))
+            Stream._incomplete_hashes[cls] = result
+            return result
 
     @property
     def hash(self):
-        return hash_bytes(self.incomplete_hash.encode('utf-8'),
-                          self.source.hash.encode('utf-8'))
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+        self._hash = hash_bytes(self.incomplete_hash.encode('utf-8'),
+                                self.source.hash.encode('utf-8'))
+        return self._hash
 
     @property
     def width(self):
@@ -379,6 +441,7 @@ class Stream:
 
 
 class VideoStream(Stream):
+    __slots__ = ()
     type = 'video'
 
     def __init__(self, size, duration):
@@ -391,6 +454,7 @@ class VideoStream(Stream):
 
 
 class AudioStream(Stream):
+    __slots__ = ()
     type = 'audio'
 
 
@@ -496,10 +560,19 @@ def generate_filter_graph(streams):
 
 
 class Filter(collections.namedtuple('Filter', 'name arg_tuples inputs outputs hash')):
-    def __new__(cls, name, args, inputs, outputs):
+    __slots__ = ()
+
+    def __new__(cls, name, args, inputs, outputs, *, hash_args=None):
+        # hash_args, if given, are hashed instead of args (e.g. to identify
+        # input files by content rather than by name)
         hash_components = [cls.__name__.encode('utf-8'), name.encode('utf-8')]
         arg_tuples = tuple(sorted((str(k), str(v)) for k, v in args.items()))
-        for k, v in arg_tuples:
+        if hash_args is None:
+            hash_arg_tuples = arg_tuples
+        else:
+            hash_arg_tuples = sorted((str(k), str(v))
+                                     for k, v in hash_args.items())
+        for k, v in hash_arg_tuples:
             hash_components.extend([k.encode('utf-8'), v.encode('utf-8')])
         hash_components.append(b'\0')
         for inp in inputs:
@@ -531,16 +604,100 @@ def filter_streams(streams, types, name, args):
             yield stream
 
 
-def filter_movie(filename, stream_specs=None, duration=None, loop=None):
+# Only these ffprobe fields are kept (and cached)
+PROBE_STREAM_FIELDS = 'codec_type', 'width', 'height', 'duration'
+PROBE_FORMAT_FIELDS = 'duration', 'start_time'
+
+probe_executor = ThreadPoolExecutor(8)
+
+
+class ProbeInfo(objects.Object):
+    ext = '.probe'
+
+    def __init__(self, input_filename, fingerprint):
+        self.input_filename = input_filename
+        # Probes made with other fields kept are different objects
+        fields = repr((PROBE_STREAM_FIELDS, PROBE_FORMAT_FIELDS))
+        self.hash = hash_bytes(type(self).__name__.encode('utf-8'),
+                               fingerprint.encode('utf-8'),
+                               fields.encode('utf-8'))
+
+    def save_to(self, filename):
+        info = json.loads(run([
+            'ffprobe',
+            '-print_format', 'json',
+            '-show_streams',
+            '-show_format',
+            self.input_filename
+        ]).decode('utf-8'))
+        print(info)
+        compact = {
+            'streams': [
+                {k: s[k] for k in PROBE_STREAM_FIELDS if k in s}
+                for s in info['streams']
+            ],
+            'format': {k: info['format'][k]
+                       for k in PROBE_FORMAT_FIELDS if k in info['format']},
+        }
+        with open(filename, 'w') as f:
+            json.dump(compact, f)
+
+    @property
+    def info(self):
+        return objects.registry.payload(
+            (self.hash, 'info'),
+            lambda: json.loads(self.read_bytes().decode('utf-8')),
+            size=1000)
+
+
+def _probe_info(filename, fingerprint=None):
+    if fingerprint is None:
+        fingerprint = objects.fingerprint_file(filename)
+    return objects.registry.intern(ProbeInfo(filename, fingerprint))
+
+
+def probe_many(filenames):
+    """Make sure the given files are probed, running ffprobe in parallel
+
+    Parts of "concat:" inputs are probed individually.
+    """
+    probes = []
+    for filename in filenames:
+        if filename.startswith('concat:'):
+            for part in filename[len('concat:'):].split('|'):
+                probes.append(_probe_info(part))
+        else:
+            probes.append(_probe_info(filename))
+    list(probe_executor.map(lambda p: p.filename, probes))
+    return probes
+
+
+def probe(filename, fingerprint=None):
+    """Return (compacted) ffprobe information on the given file"""
+    if not filename.startswith('concat:'):
+        return _probe_info(filename, fingerprint).info
+    # Probe the parts of a concatenation, and add the durations up
+    infos = [p.info for p in probe_many([filename])]
+    first = infos[0]
+    streams = []
+    for i, stream in enumerate(first['streams']):
+        stream = dict(stream)
+        if 'duration' in stream:
+            stream['duration'] = sum(float(info['streams'][i]['duration'])
+                                     for info in infos)
+        streams.append(stream)
+    format = dict(first['format'])
+    if 'duration' in format:
+        format['duration'] = sum(float(info['format']['duration'])
+                                 for info in infos)
+    return {'streams': streams, 'format': format}
+
+
+def filter_movie(filename, stream_specs=None, duration=None, loop=None,
+                 fingerprint=None, size=None, seek_point=None):
     outputs = []
-    info = json.loads(run([
-        'ffprobe',
-        '-print_format', 'json',
-        '-show_streams',
-        '-show_format',
-        filename
-    ]).decode('utf-8'))
-    print(info)
+    if size is None or duration is None or stream_specs is None:
+        info = probe(filename, fingerprint)
     if stream_specs is None:
         stream_specs = ('dv', )
         if any(s['codec_type'] == 'audio' for s in info['streams']):
@@ -548,14 +705,18 @@ def filter_movie(filename, stream_specs=None, duration=None, loop=None):
     args = {'filename': filename, 'streams': '+'.join(stream_specs)}
     if loop:
         args['loop'] = loop
+    if seek_point:
+        args['seek_point'] = seek_point
     for stream_spec in stream_specs:
         if stream_spec == 'dv':
-            for sinfo in info['streams']:
-                if sinfo['codec_type'] == 'video':
-                    break
-            else:
-                raise LookupError('no stream')
-            size = int(sinfo['width']), int(sinfo['height'])
+            if size is None or duration is None:
+                for sinfo in info['streams']:
+                    if sinfo['codec_type'] == 'video':
+                        break
+                else:
+                    raise LookupError('no stream')
+            if size is None:
+                size = int(sinfo['width']), int(sinfo['height'])
             if duration is None:
                 try:
                     s_duration = float(sinfo['duration'])
@@ -569,11 +730,15 @@ def filter_movie(filename, stream_specs=None, duration=None, loop=None):
         else:
             raise ValueError(
                 'stream specification {!r} not implemented'.format(stream_spec))
+    hash_args = dict(args)
+    if fingerprint is not None:
+        hash_args['filename'] = fingerprint
     return Filter(
         name='movie',
         args=args,
         inputs=(),
         outputs=tuple(outputs),
+        hash_args=hash_args,
     )
 
 